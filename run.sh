@@ -6,5 +6,11 @@
 # wait for the proxy to spin up
 #sleep 1
 
+# Start the worker which sends queued emails
+/usr/local/bin/python /app/src/manage.py send_queued_emails &
+
 # Start the server
-/usr/local/bin/gunicorn --bind=0.0.0.0:$PORT --pythonpath=/app/src project.wsgi --reload --workers=3
+# threaded workers so that players' long-poll requests (see matthews:wait) don't tie up a whole worker;
+# each process holds at most LONG_POLL_MAX_WAITERS of them, leaving the other threads for the game
+/usr/local/bin/gunicorn --bind=0.0.0.0:$PORT --pythonpath=/app/src project.wsgi --reload --workers=3 \
+                        --worker-class=gthread --threads=25
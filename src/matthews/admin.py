@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Game, Player, Action, Character
+from .models import Game, Player, Action, Character, QueuedEmail
 
 admin.site.register(Game)
 admin.site.register(Action)
@@ -13,5 +13,9 @@ class PlayerAdmin(admin.ModelAdmin):
 class CharacterAdmin(admin.ModelAdmin):
     list_display = ['id', 'name']
 
+@admin.register(QueuedEmail)
+class QueuedEmailAdmin(admin.ModelAdmin):
+    list_display = ['subject', 'recipients', 'date_queued', 'date_sent', 'attempts', 'last_error']
+
 
 
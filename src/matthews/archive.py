@@ -0,0 +1,135 @@
+""" moves finished and abandoned games out of the game tables into one compressed document per
+    game, so the tables every request reads only hold the games being played
+"""
+import json
+import zlib
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import Max, Q
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import Action, ArchivedGame, EventSnapshot, Game, GameEvent, Player
+from .snapshot import GameSnapshot
+
+# bump when the document's layout changes, so loaders can tell old documents apart
+FORMAT_VERSION = 1
+
+
+def find_archivable_games(finished_days, abandoned_days):
+    """ returns the ids of games which finished over `finished_days` ago or haven't been touched in
+        `abandoned_days`, leaving out any linked by `next_game` to a game which isn't archivable,
+        so that chains of games are always archived together
+    """
+    now = timezone.now()
+    last_active = Coalesce(Max('events__date_created'), 'date_started')
+    ids = set(Game.objects.annotate(last_active=last_active)
+                          .filter(Q(results__isnull=False, last_active__lt=now - timedelta(days=finished_days))
+                                  | Q(last_active__lt=now - timedelta(days=abandoned_days))
+                                  # games set up but never started before there was an event log
+                                  | Q(last_active__isnull=True))
+                          .values_list('id', flat=True))
+
+    links = {}
+    for id, next_game_id in Game.objects.filter(next_game__isnull=False).values_list('id', 'next_game_id'):
+        links.setdefault(id, set()).add(next_game_id)
+        links.setdefault(next_game_id, set()).add(id)
+
+    archivable = set()
+    for id in ids:
+        if id in archivable:
+            continue
+        chain, unvisited = set(), [id]
+        while unvisited:
+            game_id = unvisited.pop()
+            if game_id not in chain:
+                chain.add(game_id)
+                unvisited += links.get(game_id, [])
+        if chain <= ids:
+            archivable |= chain
+    return sorted(archivable)
+
+
+def archive_games(game_ids):
+    """ archives the games and deletes them from the game tables, in one transaction. Returns the
+        total size of the games' documents before and after compression
+    """
+    with transaction.atomic():
+        games   = list(Game.objects.filter(id__in=game_ids).select_for_update())
+        players = _group(Player.objects.filter(game_id__in=game_ids).order_by('id'), lambda x: x.game_id)
+        actions = _group(Action.objects.filter(game_id__in=game_ids).order_by('id')
+                                       .values_list('game_id', 'id', 'round', 'done_by_id', 'done_to_id'),
+                         lambda x: x[0])
+        events  = _group(GameEvent.objects.filter(game_id__in=game_ids).order_by('id')
+                                          .values_list('game_id', 'id', 'type', 'data', 'date_created'),
+                         lambda x: x[0])
+
+        archived = []
+        num_bytes = num_compressed_bytes = 0
+        for game in games:
+            document = json.dumps(dump_game(game, players.get(game.id, []), actions.get(game.id, []),
+                                            events.get(game.id, [])), separators=(',', ':')).encode('utf-8')
+            data = zlib.compress(document, 9)
+            archived.append(ArchivedGame(id=game.id, next_game_id=game.next_game_id,
+                                         date_started=game.date_started, data=data))
+            num_bytes += len(document)
+            num_compressed_bytes += len(data)
+        ArchivedGame.objects.bulk_create(archived)
+
+        # children first, so deleting the games doesn't have to collect them
+        Action.objects.filter(game_id__in=game_ids).delete()
+        GameEvent.objects.filter(game_id__in=game_ids).delete()
+        EventSnapshot.objects.filter(game_id__in=game_ids).delete()
+        Player.objects.filter(game_id__in=game_ids).delete()
+        Game.objects.filter(id__in=game_ids).delete()
+    return num_bytes, num_compressed_bytes
+
+
+def _group(rows, get_game_id):
+    """ returns {game id: [rows]} """
+    groups = {}
+    for row in rows:
+        groups.setdefault(get_game_id(row), []).append(row)
+    return groups
+
+
+def dump_game(game, players, actions, events):
+    """ returns the game as a JSON-ready document, given its `actions` as (game_id, id, round,
+        done_by_id, done_to_id) and `events` as (game_id, id, type, data, date_created)
+    """
+    return {
+        'format':  FORMAT_VERSION,
+        'game': {
+            'id':            game.id,
+            'date_started':  game.date_started.isoformat() if game.date_started else None,
+            'options':       game.options,
+            'next_game_id':  game.next_game_id,
+            'round':         game.round,
+            'round_actions': game.round_actions,
+            'version':       game.version,
+            'results':       game.results,
+        },
+        'players': [{'id': x.id, 'name': x.name, 'character_id': x.character_id,
+                     'died_in_round': x.died_in_round, 'death_report': x.death_report} for x in players],
+        'actions': [[id, round, done_by_id, done_to_id] for _, id, round, done_by_id, done_to_id in actions],
+        'events':  [[id, type, data, date_created.isoformat()] for _, id, type, data, date_created in events],
+    }
+
+
+def load_archived_game(game_id):
+    """ returns a GameSnapshot of the archived game with its event log as `snapshot.events`. It's
+        for reading only: its game, players and actions aren't in the game tables, and saving them
+        would put them back there
+    """
+    document = json.loads(zlib.decompress(ArchivedGame.objects.get(id=game_id).data))
+    date_started = document['game']['date_started']
+    game = Game(**{**document['game'], 'date_started': parse_datetime(date_started) if date_started else None})
+    players = [Player(game=game, **x) for x in document['players']]
+    actions = [Action(id=id, game=game, round=round, done_by_id=done_by_id, done_to_id=done_to_id,
+                      is_night=round % 2 == 1)
+               for id, round, done_by_id, done_to_id in document['actions']]
+    snapshot = GameSnapshot(game, players, actions)
+    snapshot.events = [(type, data, parse_datetime(date_created)) for _, type, data, date_created in document['events']]
+    return snapshot
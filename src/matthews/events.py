@@ -0,0 +1,152 @@
+""" an append-only log of everything that happens in a game, written alongside the game's own
+    tables, from which the game's state can be rebuilt to audit a disputed round or to check the
+    tables against (see the replay_events command)
+"""
+from datetime import timedelta
+
+from django.utils import timezone
+
+from .models import Action, EventSnapshot, GameEvent
+
+JOINED          = 'joined'           # player_id, name
+LEFT            = 'left'             # player_id
+STARTED         = 'started'          # roles: [[player_id, character_id], ...]
+CAST            = 'cast'             # round, done_by, done_to (a player id or None for nobody)
+UNDONE          = 'undone'           # round, done_by
+RESOLVED        = 'resolved'         # round, victims: [player_id, ...]
+RESTARTED       = 'restarted'        # (nothing), the game goes back to being set up
+ROUND_RESTARTED = 'round_restarted'  # round, which is played again along with every round after it
+
+# a replay which had to apply this many events saves a checkpoint for the next one to start from
+CHECKPOINT_EVERY = 100
+# games also save a checkpoint as they reach every this many rounds, see `checkpoint`
+CHECKPOINT_ROUNDS = 10
+# events newer than this are left out of checkpoints, as an event with a lower id could still be
+# committed by another transaction and would then be skipped by replays starting from the checkpoint
+CHECKPOINT_DELAY = timedelta(minutes=1)
+
+
+def record(game, type, **data):
+    GameEvent.objects.create(game=game, type=type, data=data)
+
+
+def record_many(game, events):
+    """ appends `events`, a list of (type, data), to the game's log in one query """
+    GameEvent.objects.bulk_create([GameEvent(game=game, type=type, data=data) for type, data in events])
+
+
+def new_state():
+    """ returns the state of a game with no events. Ids are kept as strings, as they would be
+        after a round trip through JSON
+    """
+    return {
+        'started': False,
+        'round':   0,
+        'players': {},  # player id: {'name', 'character_id', 'died_in_round'}
+        'actions': {},  # round: {done_by: done_to}
+    }
+
+
+def apply(state, type, data):
+    """ updates `state` with the event and returns it """
+    players = state['players']
+    if type == JOINED:
+        players[str(data['player_id'])] = {'name': data['name'], 'character_id': None, 'died_in_round': None}
+    elif type == LEFT:
+        players.pop(str(data['player_id']), None)
+    elif type == STARTED:
+        state['started'] = True
+        for player_id, character_id in data['roles']:
+            players[str(player_id)]['character_id'] = character_id
+    elif type == CAST:
+        state['actions'].setdefault(str(data['round']), {})[str(data['done_by'])] = data['done_to']
+    elif type == UNDONE:
+        actions = state['actions'].get(str(data['round']), {})
+        actions.pop(str(data['done_by']), None)
+        if not actions:
+            state['actions'].pop(str(data['round']), None)
+    elif type == RESOLVED:
+        state['round'] = data['round'] + 1
+        for victim_id in data['victims']:
+            players[str(victim_id)]['died_in_round'] = data['round']
+    elif type == RESTARTED:
+        state.update(started=False, round=0, actions={})
+        for player in players.values():
+            player.update(character_id=None, died_in_round=None)
+    elif type == ROUND_RESTARTED:
+        round = data['round']
+        state['round']   = min(state['round'], round)
+        state['actions'] = {k: v for k, v in state['actions'].items() if int(k) < round}
+        for player in players.values():
+            if player['died_in_round'] is not None and player['died_in_round'] >= round:
+                player['died_in_round'] = None
+    else:
+        raise ValueError('Unknown event type {}'.format(type))
+    return state
+
+
+def replay(game):
+    """ returns the game's state rebuilt from its latest checkpoint and the events since, saving a
+        new checkpoint if there were a lot of them
+    """
+    state, events = _load_since_checkpoint(game)
+
+    # only the run of events older than CHECKPOINT_DELAY can go into a checkpoint
+    cutoff = timezone.now() - CHECKPOINT_DELAY
+    num_settled = next((i for i, x in enumerate(events) if x[3] > cutoff), len(events))
+    for i, (id, type, data, _) in enumerate(events):
+        apply(state, type, data)
+        if i + 1 == num_settled >= CHECKPOINT_EVERY:
+            EventSnapshot.objects.create(game=game, last_event_id=id, state=state)
+    return state
+
+
+def checkpoint(game):
+    """ saves a checkpoint of the game's state as of its latest event. Only call holding the game's
+        lock (see views.lock_game) once it has started, as every event is then written under that
+        lock, so none can still be committed with a lower id
+    """
+    state, events = _load_since_checkpoint(game)
+    for _, type, data, _ in events:
+        apply(state, type, data)
+    if events:
+        EventSnapshot.objects.create(game=game, last_event_id=events[-1][0], state=state)
+
+
+def _load_since_checkpoint(game):
+    """ returns the state saved in the game's latest checkpoint and the events since it """
+    checkpoint = game.event_snapshots.order_by('-last_event_id').first()
+    state   = checkpoint.state if checkpoint else new_state()
+    last_id = checkpoint.last_event_id if checkpoint else 0
+    events  = list(game.events.filter(id__gt=last_id).order_by('id')
+                              .values_list('id', 'type', 'data', 'date_created'))
+    return state, events
+
+
+def state_from_tables(game):
+    """ returns the game's state as stored in its own tables, in the form `replay` returns """
+    players = {str(x.id): {'name': x.name, 'character_id': x.character_id, 'died_in_round': x.died_in_round}
+               for x in game.players.all()}
+    actions = {}
+    for round, done_by_id, done_to_id in Action.objects.filter(game=game).values_list('round', 'done_by_id', 'done_to_id'):
+        actions.setdefault(str(round), {})[str(done_by_id)] = done_to_id
+    return {
+        'started': game.date_started is not None,
+        'round':   game.round,
+        'players': players,
+        'actions': actions,
+    }
+
+
+def verify(game):
+    """ returns a description of each way the game's tables differ from its replayed events """
+    replayed = replay(game)
+    stored   = state_from_tables(game)
+    differences = ['{} is stored as {} but replays as {}'.format(key, stored[key], replayed[key])
+                   for key in ['started', 'round'] if stored[key] != replayed[key]]
+    for key, name in [('players', 'player'), ('actions', 'actions in round')]:
+        for id in sorted(set(stored[key]) | set(replayed[key]), key=int):
+            if stored[key].get(id) != replayed[key].get(id):
+                differences.append('{} {}: stored as {} but replays as {}'
+                                   .format(name, id, stored[key].get(id), replayed[key].get(id)))
+    return differences
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+
+from matthews.archive import archive_games, find_archivable_games
+
+
+class Command(BaseCommand):
+    help = ("Moves finished and abandoned games, with any games they continue into or from, out of the game "
+            "tables into compressed documents in the archived game table, deleting them in batches")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--finished-days', type=int, default=7, help='Archive finished games this many days old')
+        parser.add_argument('--abandoned-days', type=int, default=30,
+                            help='Archive unfinished games untouched for this many days')
+        parser.add_argument('--batch-size', type=int, default=100, help='Games to archive in each transaction')
+        parser.add_argument('--dry-run', action='store_true', help="List the games which would be archived")
+
+    def handle(self, *args, **options):
+        game_ids = find_archivable_games(options['finished_days'], options['abandoned_days'])
+        if options['dry_run']:
+            self.stdout.write('Would archive {} games: {}'.format(len(game_ids), ', '.join(map(str, game_ids))))
+            return
+
+        num_bytes = num_compressed_bytes = 0
+        batch_size = options['batch_size']
+        for start in range(0, len(game_ids), batch_size):
+            sizes = archive_games(game_ids[start:start + batch_size])
+            num_bytes += sizes[0]
+            num_compressed_bytes += sizes[1]
+            self.stdout.write('Archived {} of {} games'.format(min(start + batch_size, len(game_ids)), len(game_ids)))
+
+        self.stdout.write(self.style.SUCCESS('Archived {} games, compressing {} bytes to {}'
+                                             .format(len(game_ids), num_bytes, num_compressed_bytes)))
@@ -0,0 +1,190 @@
+import json
+import random
+import statistics
+import time
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import Client, override_settings
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.urls import reverse
+
+from matthews.models import Game, MAFIA_ID, DOCTOR_ID, DETECTIVE_ID
+from matthews.snapshot import GameSnapshot
+from matthews.synthetic import make_game, play_game, decisive_target, login
+from matthews.views import make_invite_hash, save_action
+
+SIZES = [5, 15, 50, 200]
+
+# The most queries each view may make, as (fixed, per player), so views which have to act for
+# every player (like cast-all) can grow with the game but nothing else can
+QUERY_BUDGETS = {
+    'home':                 (0, 0),
+    'new_game':             (9, 0),
+    'invite':               (6, 0),
+    'join':                 (8, 0),
+    'game (pre-start)':     (6, 0),
+    'update_options':       (6, 0),
+    'remove_player':        (13, 0),
+    'start':                (9, 0),
+    'game (day)':           (6, 0),
+    'game (night)':         (6, 0),
+    'game (endgame)':       (6, 0),
+    'state':                (2, 0),
+    'wait':                 (2, 0),
+    'target':               (11, 0),
+    'target (last vote)':   (16, 0),
+    'cast-all':             (20, 6),
+    'restart_round':        (11, 0),
+    'restart':              (8, 0),
+}
+
+OPTIONS = {
+    'roles': {MAFIA_ID: {'min': 1, 'pc': 25}, DOCTOR_ID: {'min': 1, 'pc': 10}, DETECTIVE_ID: {'min': 1, 'pc': 10}},
+    'gameplay': ['show_suspicion_pc_on_death'],
+}
+
+
+class Command(BaseCommand):
+    help = ("Times every matthews view against synthetic games of each size in a throwaway test "
+            "database, writing the results as JSON and failing if any view goes over its query budget. "
+            "Uses whichever database is configured, so set IS_PRODUCTION and DJANGO_DB_* to run against Postgres")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', nargs='+', type=int, default=SIZES, help='Numbers of players to benchmark')
+        parser.add_argument('--repeat', type=int, default=3, help='Times to request each view')
+        parser.add_argument('--output', default='benchmark.json', help='File to write the results to')
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            # a local cache keeps a shared memcached out of it, and is cleared before each request
+            # so every count is the worst case of a cache miss
+            with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+                                   BLOCK_EMAIL_SENDING=True,
+                                   LONG_POLL_SECONDS=0):
+                results = []
+                for num_players in options['sizes']:
+                    for name, prepare in self.requests(num_players):
+                        results.append(self.benchmark(name, num_players, prepare, options['repeat']))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        with open(options['output'], 'w') as f:
+            json.dump({'database': connection.vendor, 'results': results}, f, indent=2)
+
+        over_budget = [x for x in results if x['queries'] > x['budget']]
+        for result in results:
+            style = self.style.ERROR if result in over_budget else self.style.SUCCESS
+            self.stdout.write(style('{view:20} {players:4} players {queries:4} queries (budget {budget:4}) '
+                                    '{median_ms:8.1f}ms'.format(**result)))
+        if over_budget:
+            raise CommandError('{} views went over their query budget, see {}'.format(len(over_budget), options['output']))
+
+    def requests(self, num_players):
+        """ yields (view name, prepare) for each request to benchmark, where `prepare` returns the
+            client, method, url and data of the request to time
+        """
+        pre_start = make_game(num_players, started=False)
+        pre_start.options = OPTIONS
+        pre_start.save()
+        leader = pre_start.players.order_by('id').first()
+        last_player = pre_start.players.order_by('id').last()
+        day     = self.played_game(num_players, 2)
+        night   = self.played_game(num_players, 3)
+        endgame = self.played_game(num_players, None)
+
+        def as_player(game, alive=False):
+            players = game.players.order_by('id')
+            return login(Client(), players.filter(died_in_round__isnull=True).first() if alive else players.first())
+
+        def last_vote():
+            rng = random.Random(0)
+            snapshot = GameSnapshot(Game.objects.get(id=day.id))
+            player, *others = snapshot.yet_to_vote(snapshot.round)
+            for other in others:
+                save_action(snapshot, other, decisive_target(snapshot, other, rng))
+            target = decisive_target(snapshot, player, rng)
+            return login(Client(), player), 'post', reverse('matthews:target'), {'round': snapshot.round, 'target': target.id}
+
+        game_url = reverse('matthews:game')
+        yield 'home',              lambda: (Client(), 'get', reverse('matthews:home'), {})
+        yield 'new_game',          lambda: (Client(), 'get', reverse('matthews:new_game'), {'leader': 'Bench'})
+        yield 'invite',            lambda: (as_player(pre_start), 'post', reverse('matthews:invite', kwargs={'id': pre_start.id}),
+                                            {'name_and_email': 'Newcomer,'})
+        yield 'join',              lambda: (Client(), 'get', reverse('matthews:join', kwargs={
+                                                'id': pre_start.id, 'name': 'Newcomer',
+                                                'hash': make_invite_hash(pre_start.id, 'Newcomer')}), {})
+        yield 'game (pre-start)',  lambda: (as_player(pre_start), 'get', game_url, {})
+        yield 'update_options',    lambda: (login(Client(), leader), 'post', reverse('matthews:update_options'),
+                                            {'character_ids[]': [str(MAFIA_ID)], 'min_{}'.format(MAFIA_ID): 1,
+                                             'pc_{}'.format(MAFIA_ID): 25})
+        yield 'remove_player',     lambda: (login(Client(), leader), 'get',
+                                            reverse('matthews:remove_player', kwargs={'id': last_player.id}), {})
+        yield 'start',             lambda: (login(Client(), leader), 'get', reverse('matthews:start'), {})
+        yield 'game (day)',        lambda: (as_player(day, alive=True), 'get', game_url, {})
+        yield 'game (night)',      lambda: (as_player(night, alive=True), 'get', game_url, {})
+        yield 'game (endgame)',    lambda: (as_player(endgame), 'get', game_url, {})
+        yield 'state',             lambda: (as_player(day), 'get', reverse('matthews:state'), {})
+        yield 'wait',              lambda: (as_player(day), 'get', reverse('matthews:wait'), {'token': ''})
+        yield 'target',            lambda: (as_player(day, alive=True), 'post', reverse('matthews:target'),
+                                            {'round': day.round, 'target': 0})
+        yield 'cast-all',          lambda: (as_player(day), 'get', reverse('matthews:cast-all'), {})
+        yield 'restart_round',     lambda: (as_player(endgame), 'get',
+                                            reverse('matthews:restart_round', kwargs={'round': 1}), {})
+        yield 'restart',           lambda: (as_player(endgame), 'get', reverse('matthews:restart'), {})
+        yield 'target (last vote)', last_vote
+
+    def played_game(self, num_players, num_rounds):
+        """ returns a game which has been played to `num_rounds` (or to its end if None) """
+        for seed in range(100):
+            game = play_game(make_game(num_players), random.Random(seed), max_rounds=num_rounds or 1000,
+                             choose_target=decisive_target)
+            if num_rounds is None or game.round == num_rounds:
+                return game
+        raise CommandError("Couldn't play a {} player game to round {}".format(num_players, num_rounds))
+
+    def benchmark(self, name, num_players, prepare, repeat):
+        """ makes the request `prepare` sets up `repeat` times, rolling back each time so every
+            request sees the same game, and returns its query count and timings
+        """
+        fixed, per_player = QUERY_BUDGETS[name]
+        timings = []
+        num_queries = 0
+        for _ in range(repeat):
+            # counted as they run rather than from connection.queries, whose log is capped so can
+            # come back empty once a lot of queries have been made
+            request_queries = [0]
+
+            def count_query(execute, sql, params, many, context):
+                # savepoints only come from running inside the rollback transaction below
+                if 'SAVEPOINT' not in sql:
+                    request_queries[0] += 1
+                return execute(sql, params, many, context)
+
+            with transaction.atomic():
+                client, method, url, data = prepare()
+                cache.clear()
+                with connection.execute_wrapper(count_query):
+                    start = time.perf_counter()
+                    response = getattr(client, method)(url, data)
+                    timings.append((time.perf_counter() - start) * 1000)
+                transaction.set_rollback(True)
+
+            if response.status_code >= 400:
+                raise CommandError('{} returned {} for {} players'.format(name, response.status_code, num_players))
+            num_queries = max(num_queries, request_queries[0])
+
+        return {
+            'view':      name,
+            'players':   num_players,
+            'queries':   num_queries,
+            'budget':    fixed + per_player * num_players,
+            'min_ms':    min(timings),
+            'median_ms': statistics.median(timings),
+            'max_ms':    max(timings),
+        }
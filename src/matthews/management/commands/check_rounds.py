@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+
+from matthews.models import Game
+from matthews.versions import bump_version
+
+
+class Command(BaseCommand):
+    help = "Checks each game's stored round counters against its actions, optionally fixing them"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true', help='Reset inconsistent counters from the actions table')
+
+    def handle(self, *args, **options):
+        num_bad = 0
+        for game in Game.objects.order_by('id'):
+            counted = game.count_round()
+            stored  = (game.round, game.round_actions)
+            if counted == stored:
+                continue
+
+            num_bad += 1
+            self.stdout.write('{} stores round {} with {} actions but has round {} with {} actions'
+                              .format(game, *stored, *counted))
+            if options['fix']:
+                game.recount_round()
+                # so nothing keeps serving the game as cached against its old round
+                bump_version(game)
+
+        if num_bad and not options['fix']:
+            self.stdout.write(self.style.ERROR('{} inconsistent games, rerun with --fix to repair'.format(num_bad)))
+        else:
+            self.stdout.write(self.style.SUCCESS('Round counters checked'))
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from matthews import events
+from matthews.models import Game, GameEvent
+
+
+class Command(BaseCommand):
+    help = ("Rebuilds games from their event logs and checks the result against the game tables, "
+            "optionally printing each game's log to see how a disputed round played out")
+
+    def add_arguments(self, parser):
+        parser.add_argument('game_ids', nargs='*', type=int, help='Games to replay, otherwise every game with events')
+        parser.add_argument('--show', action='store_true', help="Print each game's events")
+
+    def handle(self, *args, **options):
+        games = Game.objects.filter(id__in=options['game_ids']) if options['game_ids'] else \
+                Game.objects.filter(id__in=GameEvent.objects.values('game_id'))
+
+        num_bad = 0
+        for game in games.order_by('id'):
+            if options['show']:
+                for event in game.events.order_by('id'):
+                    self.stdout.write('{} {} {:16} {}'.format(event.id, event.date_created, event.type, event.data))
+
+            differences = events.verify(game)
+            if differences:
+                num_bad += 1
+                self.stdout.write(self.style.ERROR('{} differs from its events:'.format(game)))
+                for difference in differences:
+                    self.stdout.write('  ' + difference)
+
+        if num_bad:
+            raise CommandError('{} games differ from their events'.format(num_bad))
+        self.stdout.write(self.style.SUCCESS('Replayed {} games'.format(games.count())))
@@ -0,0 +1,25 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from project.emails import send_queued_emails
+
+
+class Command(BaseCommand):
+    help = 'Sends queued emails in batches over a single SMTP connection, waiting for more until stopped'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Stop once the queue is empty')
+        parser.add_argument('--batch-size', type=int, default=settings.EMAIL_QUEUE_BATCH_SIZE)
+        parser.add_argument('--poll-seconds', type=int, default=5, help='How long to wait when the queue is empty')
+
+    def handle(self, *args, **options):
+        while True:
+            num_attempted = send_queued_emails(options['batch_size'])
+            if num_attempted:
+                self.stdout.write('Attempted {} emails'.format(num_attempted))
+            if num_attempted < options['batch_size']:
+                if options['once']:
+                    break
+                time.sleep(options['poll_seconds'])
@@ -0,0 +1,237 @@
+import random
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.cookiejar import CookieJar
+from importlib import import_module
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+from urllib.request import HTTPCookieProcessor, HTTPRedirectHandler, Request, build_opener
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.urls import reverse
+
+from matthews.models import Game, MAFIA_ID, DOCTOR_ID, DETECTIVE_ID
+from matthews.snapshot import GameSnapshot
+from matthews.synthetic import make_characters, decisive_target, random_target
+from matthews.views import make_invite_hash, GAMEPLAY_OPTIONS
+
+STRATEGIES = {
+    'decisive': decisive_target,
+    'random':   random_target,
+}
+
+
+class InProcessClient:
+    """ makes requests straight into the app with the test client """
+
+    def __init__(self):
+        self.client = Client()
+
+    def request(self, method, path, data=None):
+        return getattr(self.client, method)(path, data or {}).status_code
+
+    @property
+    def session(self):
+        return self.client.session
+
+
+class HttpClient:
+    """ makes requests to a running server, keeping its cookies like a browser would """
+
+    class NoRedirect(HTTPRedirectHandler):
+        def redirect_request(self, *args, **kwargs):
+            return None
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.cookies  = CookieJar()
+        self.opener   = build_opener(HTTPCookieProcessor(self.cookies), self.NoRedirect)
+
+    def cookie(self, name):
+        return next((x.value for x in self.cookies if x.name == name), None)
+
+    def request(self, method, path, data=None):
+        url  = self.base_url + path
+        body = None
+        headers = {'Referer': self.base_url + '/'}
+        if method == 'get' and data:
+            url += '?' + urlencode(data, doseq=True)
+        elif method == 'post':
+            body = urlencode(data or {}, doseq=True).encode('utf-8')
+            headers['X-CSRFToken'] = self.cookie(settings.CSRF_COOKIE_NAME) or ''
+        try:
+            with self.opener.open(Request(url, data=body, headers=headers)) as response:
+                response.read()
+                return response.status
+        except HTTPError as e:
+            # includes the redirects NoRedirect stops us following
+            return e.code
+
+    @property
+    def session(self):
+        return import_module(settings.SESSION_ENGINE).SessionStore(self.cookie(settings.SESSION_COOKIE_NAME))
+
+
+class Command(BaseCommand):
+    help = ("Plays games to completion with bots going through the real views, either in-process or against a "
+            "running server given by --url, and reports throughput, latency per endpoint and database queries. "
+            "Bots read each game from the database to pick their targets, so must share the server's database")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--games', type=int, default=10, help='Number of games to play')
+        parser.add_argument('--players', type=int, default=10, help='Number of players in each game')
+        parser.add_argument('--threads', type=int, default=4,
+                            help="Number of games to play at once. In-process runs on SQLite only use one, as it "
+                                 "can't take concurrent writes, so size against Postgres")
+        parser.add_argument('--mafia-pc', type=int, default=25, help='Percentage of players who are mafia')
+        parser.add_argument('--doctor-pc', type=int, default=10, help='Percentage of players who are doctors, 0 for none')
+        parser.add_argument('--detective-pc', type=int, default=10, help='Percentage of players who are detectives, 0 for none')
+        parser.add_argument('--gameplay', nargs='*', default=[], choices=list(GAMEPLAY_OPTIONS),
+                            help='Gameplay options to turn on')
+        parser.add_argument('--strategy', default='decisive', choices=list(STRATEGIES), help='How bots pick targets')
+        parser.add_argument('--max-rounds', type=int, default=500, help='Rounds after which to give up on a game')
+        parser.add_argument('--url', help='Base URL of a running server, otherwise requests are made in-process')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        self.options   = options
+        self.lock      = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors    = defaultdict(int)
+        self.queries   = defaultdict(int)
+        self.num_votes = 0
+        make_characters()
+        if not options['url'] and connection.vendor == 'sqlite' and options['threads'] > 1:
+            self.stdout.write(self.style.WARNING("SQLite can't take concurrent writes, so playing one game at a time"))
+            options['threads'] = 1
+        if not options['url']:
+            # lets the test client's requests through ALLOWED_HOSTS and keeps emails in memory
+            setup_test_environment()
+
+        start = time.perf_counter()
+        try:
+            with ThreadPoolExecutor(max_workers=options['threads']) as pool:
+                results = list(pool.map(self.play_game, range(options['games'])))
+        finally:
+            if not options['url']:
+                teardown_test_environment()
+        elapsed = time.perf_counter() - start
+        num_rounds = [x for x in results if x is not None]
+
+        self.stdout.write('{} games of {} players, {} votes over {} rounds in {:.1f}s'
+                          .format(options['games'], options['players'], self.num_votes, sum(num_rounds), elapsed))
+        self.stdout.write('{:.2f} games/sec, {:.1f} votes/sec'
+                          .format(options['games'] / elapsed, self.num_votes / elapsed))
+        self.stdout.write('{:16} {:>8} {:>8} {:>8} {:>8} {:>8} {:>10}'
+                          .format('endpoint', 'requests', 'errors', 'p50 ms', 'p95 ms', 'p99 ms', 'queries'))
+        for endpoint, latencies in sorted(self.latencies.items()):
+            latencies.sort()
+            queries = self.queries[endpoint] if not options['url'] else '-'
+            self.stdout.write('{:16} {:8} {:8} {:8.1f} {:8.1f} {:8.1f} {:>10}'
+                              .format(endpoint, len(latencies), self.errors[endpoint], percentile(latencies, 50),
+                                      percentile(latencies, 95), percentile(latencies, 99), queries))
+        if not options['url']:
+            self.stdout.write('{} queries in total'.format(sum(self.queries.values())))
+        if len(num_rounds) < len(results):
+            self.stdout.write(self.style.ERROR("{} games couldn't be set up or stalled"
+                                               .format(len(results) - len(num_rounds))))
+        if sum(self.errors.values()):
+            self.stdout.write(self.style.ERROR('{} requests failed'.format(sum(self.errors.values()))))
+
+    def make_client(self):
+        return HttpClient(self.options['url']) if self.options['url'] else InProcessClient()
+
+    def request(self, client, endpoint, method, path, data=None):
+        """ makes the request, recording how long it took and how many queries it made """
+        num_queries = [0]
+
+        def count_query(execute, sql, params, many, context):
+            num_queries[0] += 1
+            return execute(sql, params, many, context)
+
+        start = time.perf_counter()
+        try:
+            with connection.execute_wrapper(count_query):
+                status = client.request(method, path, data)
+        except Exception:
+            status = 500
+        elapsed = (time.perf_counter() - start) * 1000
+
+        with self.lock:
+            self.latencies[endpoint].append(elapsed)
+            self.queries[endpoint] += num_queries[0]
+            self.errors[endpoint]  += status >= 400
+        return status
+
+    def play_game(self, game_number):
+        """ sets up a game of bots, plays it to the end and returns how many rounds it took, or None
+            if a request it couldn't carry on without failed
+        """
+        try:
+            return self._play_game(game_number)
+        finally:
+            connection.close()
+
+    def _play_game(self, game_number):
+        options = self.options
+        rng     = random.Random('{}-{}'.format(options['seed'], game_number))
+        choose_target = STRATEGIES[options['strategy']]
+
+        leader = self.make_client()
+        self.request(leader, 'new_game', 'get', reverse('matthews:new_game'), {'leader': 'Bot0'})
+        game_id = leader.session.get('game_id')
+        if not game_id:
+            return None
+        clients = {leader.session['player_id']: leader}
+
+        for i in range(1, options['players']):
+            name   = 'Bot{}'.format(i)
+            client = self.make_client()
+            kwargs = {'id': game_id, 'name': name, 'hash': make_invite_hash(game_id, name)}
+            self.request(client, 'join', 'get', reverse('matthews:join', kwargs=kwargs))
+            # a bot whose join failed (already counted as an error) just sits the game out
+            if client.session.get('player_id'):
+                clients[client.session['player_id']] = client
+
+        roles = {MAFIA_ID: options['mafia_pc'], DOCTOR_ID: options['doctor_pc'], DETECTIVE_ID: options['detective_pc']}
+        data  = {'character_ids[]': [str(x) for x, pc in roles.items() if pc], 'game_options[]': options['gameplay'],
+                 'start': 1}
+        for id, pc in roles.items():
+            data.update({'min_{}'.format(id): 1, 'pc_{}'.format(id): pc})
+        self.request(leader, 'game', 'get', reverse('matthews:game'))
+        self.request(leader, 'update_options', 'post', reverse('matthews:update_options'), data)
+
+        for num_rounds in range(options['max_rounds']):
+            snapshot = GameSnapshot(Game.objects.get(id=game_id))
+            if not snapshot.game.date_started:
+                # starting the game failed
+                return None
+            if snapshot.endgame_type:
+                break
+            round = snapshot.round
+            for player in snapshot.yet_to_vote(round):
+                client = clients.get(player.id)
+                if not client:
+                    # the player was saved but their bot never got its session, so the game can't finish
+                    return None
+                self.request(client, 'state', 'get', reverse('matthews:state'))
+                self.request(client, 'game', 'get', reverse('matthews:game'))
+                target = choose_target(snapshot, player, rng)
+                self.request(client, 'target', 'post', reverse('matthews:target'),
+                             {'round': round, 'target': target.id if target else 0})
+                with self.lock:
+                    self.num_votes += 1
+        return num_rounds
+
+
+def percentile(values, pc):
+    """ returns the value `pc` percent of the way through sorted `values` """
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * pc / 100))]
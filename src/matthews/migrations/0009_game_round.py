@@ -0,0 +1,36 @@
+# Generated by Django 3.0.5 on 2026-10-18 09:53
+
+from django.db import migrations, models
+
+
+def backfill_rounds(apps, schema_editor):
+    Game   = apps.get_model('matthews', 'Game')
+    Action = apps.get_model('matthews', 'Action')
+    for game in Game.objects.all():
+        num_actions = Action.objects.filter(done_by__game=game).count()
+        num_players = game.players.count()
+        if num_players:
+            game.round         = num_actions // num_players
+            game.round_actions = num_actions - game.round * num_players
+            game.save(update_fields=['round', 'round_actions'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('matthews', '0008_game_next_game'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='game',
+            name='round',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='round_actions',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_rounds, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 3.0.5 on 2026-10-18 09:59
+
+from django.db import migrations
+import matthews.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('matthews', '0010_game_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='game',
+            name='results',
+            field=matthews.models.DictField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 3.0.5 on 2026-10-18 10:03
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('matthews', '0011_game_results'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueuedEmail',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('recipients', models.TextField()),
+                ('subject', models.CharField(max_length=255)),
+                ('from_email', models.CharField(blank=True, max_length=255, null=True)),
+                ('text_content', models.TextField(blank=True, null=True)),
+                ('html_content', models.TextField(blank=True, null=True)),
+                ('date_queued', models.DateTimeField(auto_now_add=True)),
+                ('date_sent', models.DateTimeField(blank=True, null=True)),
+                ('attempts', models.IntegerField(default=0)),
+                ('next_attempt', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_error', models.TextField(blank=True, null=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='queuedemail',
+            index=models.Index(fields=['date_sent', 'next_attempt'], name='matthews_qu_date_se_a97b43_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.0.5 on 2026-10-18 10:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('matthews', '0012_queuedemail'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='player',
+            name='death_report',
+            field=models.TextField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 3.0.5 on 2026-10-18 10:07
+
+from django.db import migrations, models
+
+
+def backfill_is_night(apps, schema_editor):
+    Action = apps.get_model('matthews', 'Action')
+    night_rounds = [x for x in Action.objects.values_list('round', flat=True).distinct() if x % 2 == 1]
+    Action.objects.filter(round__in=night_rounds).update(is_night=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('matthews', '0013_player_death_report'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='action',
+            name='is_night',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddIndex(
+            model_name='action',
+            index=models.Index(fields=['done_by', 'round'], name='matthews_ac_done_by_7b726d_idx'),
+        ),
+        migrations.RunPython(backfill_is_night, migrations.RunPython.noop),
+    ]
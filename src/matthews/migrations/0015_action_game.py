@@ -0,0 +1,19 @@
+# Generated by Django 3.0.5 on 2026-10-18 10:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('matthews', '0014_action_is_night'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='action',
+            name='game',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='actions', to='matthews.Game'),
+        ),
+    ]
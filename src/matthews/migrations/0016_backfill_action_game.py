@@ -0,0 +1,23 @@
+# Generated by Django 3.0.5 on 2026-10-18 10:12
+
+from django.db import migrations
+from django.db.models import OuterRef, Subquery
+
+
+def backfill_game(apps, schema_editor):
+    Action = apps.get_model('matthews', 'Action')
+    Player = apps.get_model('matthews', 'Player')
+    Action.objects.update(game_id=Subquery(Player.objects.filter(id=OuterRef('done_by_id')).values('game_id')[:1]))
+
+
+class Migration(migrations.Migration):
+    # kept apart from the schema changes either side, as on Postgres the update queues deferred
+    # foreign key checks which would stop the same transaction altering the table afterwards
+
+    dependencies = [
+        ('matthews', '0015_action_game'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_game, migrations.RunPython.noop),
+    ]
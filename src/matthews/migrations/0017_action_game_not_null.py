@@ -0,0 +1,27 @@
+# Generated by Django 3.0.5 on 2026-10-18 10:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('matthews', '0016_backfill_action_game'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='action',
+            name='game',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='actions', to='matthews.Game'),
+        ),
+        migrations.AddIndex(
+            model_name='action',
+            index=models.Index(fields=['game', 'round', 'done_by'], name='matthews_ac_game_id_ba07e3_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='action',
+            index=models.Index(fields=['game', 'round', 'done_to'], name='matthews_ac_game_id_e60c2a_idx'),
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 3.0.5 on 2026-10-18 10:31
+
+from django.db import migrations, models
+import django.db.models.deletion
+import matthews.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('matthews', '0017_action_game_not_null'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GameEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('type', models.CharField(max_length=16)),
+                ('data', matthews.models.DictField(blank=True, null=True)),
+                ('date_created', models.DateTimeField(auto_now_add=True)),
+                ('game', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='events', to='matthews.Game')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='EventSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_event_id', models.IntegerField()),
+                ('state', matthews.models.DictField()),
+                ('game', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='event_snapshots', to='matthews.Game')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='gameevent',
+            index=models.Index(fields=['game', 'id'], name='matthews_ga_game_id_a75b3f_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='eventsnapshot',
+            index=models.Index(fields=['game', 'last_event_id'], name='matthews_ev_game_id_7cc149_idx'),
+        ),
+    ]
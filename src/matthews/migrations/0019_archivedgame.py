@@ -0,0 +1,23 @@
+# Generated by Django 3.0.5 on 2026-10-18 10:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('matthews', '0018_game_events'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedGame',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('next_game_id', models.IntegerField(blank=True, null=True)),
+                ('date_started', models.DateTimeField(blank=True, null=True)),
+                ('date_archived', models.DateTimeField(auto_now_add=True)),
+                ('data', models.BinaryField()),
+            ],
+        ),
+    ]
@@ -1,6 +1,8 @@
 import json
 from django.contrib.auth.models import AbstractUser
 from django.db import models
+from django.db.models import F
+from django.utils import timezone
 
 MAFIA_ID     = 1
 CIVILIAN_ID  = 2
@@ -34,6 +36,12 @@ class Game(models.Model):
     options      = DictField(blank=True, null=True)
     next_game    = models.OneToOneField('Game', related_name='previous_game',
                                         on_delete=models.SET_NULL, blank=True, null=True)
+    # denormalised so the current round can be read without counting every action in the game
+    round         = models.IntegerField(default=0)
+    round_actions = models.IntegerField(default=0)
+    version       = models.IntegerField(default=0)
+    # end-of-game stats for each player, keyed by player id, stored once the game has finished
+    results       = DictField(blank=True, null=True)
 
     def list_good_guys(self):
         return self.players.filter(died_in_round__isnull=True) \
@@ -43,6 +51,31 @@ class Game(models.Model):
         return self.players.filter(died_in_round__isnull=True) \
                            .filter(character__id=MAFIA_ID)
 
+    def count_round(self):
+        """ returns (round, round_actions) as counted from the actions table, rather than as stored """
+        num_actions = Action.objects.filter(game=self).count()
+        num_players = self.players.count()
+        if not num_players:
+            return 0, 0
+        round = num_actions // num_players
+        return round, num_actions - round * num_players
+
+    def recount_round(self):
+        """ resets the stored round counters from the actions table """
+        self.round, self.round_actions = self.count_round()
+        Game.objects.filter(id=self.id).update(round=self.round, round_actions=self.round_actions)
+
+    def add_round_actions(self, count, num_players):
+        """ adds `count` actions to the current round's tally, moving on to the next round once
+            every player has acted. Returns True only to the one caller whose actions completed
+            the round, so that each round is resolved exactly once
+        """
+        Game.objects.filter(id=self.id).update(round_actions=F('round_actions') + count)
+        completed = Game.objects.filter(id=self.id, round=self.round, round_actions__gte=num_players) \
+                                .update(round=F('round') + 1, round_actions=0)
+        self.refresh_from_db(fields=['round', 'round_actions'])
+        return bool(completed)
+
     def __str__(self):
         return 'Game {}'.format(self.id)
 
@@ -52,6 +85,7 @@ class Player(models.Model):
     game          = models.ForeignKey('Game', related_name='players', on_delete=models.CASCADE, blank=False, null=False)
     character     = models.ForeignKey('Character', related_name='players', on_delete=models.PROTECT, blank=True, null=True)
     died_in_round = models.IntegerField(blank=True, null=True)
+    death_report  = models.TextField(blank=True, null=True)
 
     def __str__(self):
         return self.name
@@ -64,11 +98,97 @@ class Character(models.Model):
         return self.name
 
 
+# the roles never change once created (they mirror ROLE_NAMES), so each process loads them just once
+_characters = {}
+
+
+def get_character(id):
+    """ returns the Character with `id` from the process-wide index, or None if there isn't one """
+    if id not in _characters:
+        _characters.update({x.id: x for x in Character.objects.all()})
+    return _characters.get(id)
+
+
 class Action(models.Model):
-    round   = models.IntegerField(blank=False, null=False)
-    done_by = models.ForeignKey('Player', related_name='actions_by', on_delete=models.CASCADE, blank=False, null=False)
-    done_to = models.ForeignKey('Player', related_name='actions_to', on_delete=models.CASCADE, blank=True, null=True)
+    # denormalised from done_by.game so per-game lookups don't need to join through Player
+    game     = models.ForeignKey('Game', related_name='actions', on_delete=models.CASCADE, blank=False, null=False)
+    round    = models.IntegerField(blank=False, null=False)
+    done_by  = models.ForeignKey('Player', related_name='actions_by', on_delete=models.CASCADE, blank=False, null=False)
+    done_to  = models.ForeignKey('Player', related_name='actions_to', on_delete=models.CASCADE, blank=True, null=True)
+    # derived from round, stored so day/night can be filtered on (and indexed) without maths on round
+    is_night = models.BooleanField(default=False)
+
+    class Meta:
+        indexes = [models.Index(fields=['done_by', 'round']),
+                   models.Index(fields=['game', 'round', 'done_by']),
+                   models.Index(fields=['game', 'round', 'done_to'])]
+
+    def save(self, *args, **kwargs):
+        if self.game_id is None:
+            self.game_id = self.done_by.game_id
+        self.is_night = self.round % 2 == 1
+        super().save(*args, **kwargs)
 
     def __str__(self):
         #todo: remove this after debugging
-        return 'round {}: {} targeted {}'.format(self.round, self.done_by, self.done_to)
\ No newline at end of file
+        return 'round {}: {} targeted {}'.format(self.round, self.done_by, self.done_to)
+
+
+class GameEvent(models.Model):
+    """ one entry in a game's append-only log of what happened in it, see matthews.events """
+    game         = models.ForeignKey('Game', related_name='events', on_delete=models.CASCADE, blank=False, null=False)
+    type         = models.CharField(max_length=16, blank=False, null=False)
+    data         = DictField(blank=True, null=True)
+    date_created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['game', 'id'])]
+
+    def __str__(self):
+        return '{} {}: {} {}'.format(self.game, self.id, self.type, self.data)
+
+
+class EventSnapshot(models.Model):
+    """ a game's state as replayed from its events up to and including `last_event_id`, so later
+        replays can start from here rather than from the game's first event
+    """
+    game          = models.ForeignKey('Game', related_name='event_snapshots', on_delete=models.CASCADE, blank=False, null=False)
+    last_event_id = models.IntegerField(blank=False, null=False)
+    state         = DictField(blank=False, null=False)
+
+    class Meta:
+        indexes = [models.Index(fields=['game', 'last_event_id'])]
+
+
+class ArchivedGame(models.Model):
+    """ a finished or abandoned game moved out of the game tables by the archive_games command,
+        stored as a zlib-compressed JSON document, see matthews.archive
+    """
+    id            = models.IntegerField(primary_key=True)  # the game's own id
+    next_game_id  = models.IntegerField(blank=True, null=True)
+    date_started  = models.DateTimeField(blank=True, null=True)
+    date_archived = models.DateTimeField(auto_now_add=True)
+    data          = models.BinaryField()
+
+    def __str__(self):
+        return 'Archived game {}'.format(self.id)
+
+
+class QueuedEmail(models.Model):
+    """ an email waiting to be sent by the send_queued_emails command, see project.emails """
+    recipients   = models.TextField(blank=False, null=False)  # comma separated
+    subject      = models.CharField(max_length=255, blank=False, null=False)
+    from_email   = models.CharField(max_length=255, blank=True, null=True)
+    text_content = models.TextField(blank=True, null=True)
+    html_content = models.TextField(blank=True, null=True)
+    date_queued  = models.DateTimeField(auto_now_add=True)
+    date_sent    = models.DateTimeField(blank=True, null=True)
+    attempts     = models.IntegerField(default=0)
+    next_attempt = models.DateTimeField(default=timezone.now)
+    last_error   = models.TextField(blank=True, null=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['date_sent', 'next_attempt'])]
+
+    def __str__(self):
+        return '{} to {}'.format(self.subject, self.recipients)
\ No newline at end of file
@@ -0,0 +1,27 @@
+""" the game and player a visitor is in, as kept in their session """
+from functools import wraps
+
+
+def get_session_ids(request):
+    """ returns (game id, player id) from the request's session, only reading it the first time """
+    if not hasattr(request, 'session_ids'):
+        request.session_ids = (request.session.get('game_id'), request.session.get('player_id'))
+    return request.session_ids
+
+
+def set_session_ids(request, game_id, player_id):
+    request.session['game_id']   = game_id
+    request.session['player_id'] = player_id
+    request.session_ids = (game_id, player_id)
+
+
+def readonly_session(view):
+    """ stops the session being saved after `view`, whatever it or the messages framework touched,
+        for endpoints which are polled too often to write on
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        response = view(request, *args, **kwargs)
+        request.session.modified = False
+        return response
+    return wrapper
@@ -0,0 +1,137 @@
+""" an in-memory view of a game, loaded once per request """
+from django.conf import settings
+from django.core.cache import cache
+
+from project import metrics
+from .models import Action, Game, MAFIA_ID, get_character
+from .versions import get_version, make_state_token
+
+
+class GameSnapshot:
+    """ loads a game's players and actions once then answers questions about the game (round,
+        who's alive, endgame type, etc.) from memory rather than with repeated count queries.
+        Writes made through the snapshot's helpers (eg `add_action`) keep it up to date
+    """
+
+    def __init__(self, game, players=None, actions=None):
+        self.game    = game
+        self.players = players if players is not None else list(game.players.order_by('id'))
+        # only the current and previous rounds' actions are needed to render and advance a game
+        self.actions = actions if actions is not None else \
+                       list(Action.objects.filter(game=game, round__gte=game.round-1)
+                                          .order_by('id'))
+        self.players_by_id = {x.id: x for x in self.players}
+        for player in self.players:
+            if player.character_id is not None:
+                player.character = get_character(player.character_id) or player.character
+        for action in self.actions:
+            self._link_action(action)
+        # round: (actions by done_by_id, actions by done_to_id), see `actions_by` and `actions_to`
+        self._indexes = {}
+
+    def _link_action(self, action):
+        """ points the action at this snapshot's players so templates reading `done_by` and
+            `done_to` don't load each of them with a query
+        """
+        if action.done_by_id in self.players_by_id:
+            action.done_by = self.players_by_id[action.done_by_id]
+        if action.done_to_id in self.players_by_id:
+            action.done_to = self.players_by_id[action.done_to_id]
+
+    @classmethod
+    def load(cls, game_id):
+        """ returns a snapshot of the game from the cache shared by all workers, loading and caching
+            it if this version of the game hasn't been seen yet. Only use for reading: anything
+            which writes should build a fresh snapshot from the database
+        """
+        version = get_version(game_id)
+        cached  = cache.get(_snapshot_cache_key(game_id, version)) if version is not None else None
+        metrics.inc('matthews_snapshot_cache_hits_total' if cached else 'matthews_snapshot_cache_misses_total')
+        if cached:
+            return cls(*cached)
+
+        snapshot = cls(Game.objects.get(id=game_id))
+        cache.set(_snapshot_cache_key(game_id, snapshot.game.version),
+                  (snapshot.game, snapshot.players, snapshot.actions),
+                  settings.GAME_SNAPSHOT_CACHE_SECONDS)
+        return snapshot
+
+    @property
+    def round(self):
+        return self.game.round
+
+    def get_player(self, id):
+        return self.players_by_id.get(id)
+
+    def alive_players(self):
+        return [x for x in self.players if x.died_in_round is None]
+
+    def list_good_guys(self):
+        return [x for x in self.alive_players() if x.character_id != MAFIA_ID]
+
+    def list_bad_guys(self):
+        return [x for x in self.alive_players() if x.character_id == MAFIA_ID]
+
+    def actions_in_round(self, round):
+        return [x for x in self.actions if x.round == round]
+
+    def _index_round(self, round):
+        if round not in self._indexes:
+            actions_by, actions_to = {}, {}
+            for action in self.actions_in_round(round):
+                actions_by[action.done_by_id] = action
+                actions_to.setdefault(action.done_to_id, []).append(action)
+            self._indexes[round] = actions_by, actions_to
+        return self._indexes[round]
+
+    def actions_by(self, round):
+        """ returns {player id: the action they took in `round`} """
+        return self._index_round(round)[0]
+
+    def actions_to(self, round):
+        """ returns {player id (or None for nobody): [actions targeting them in `round`]} """
+        return self._index_round(round)[1]
+
+    def get_action(self, player, round):
+        """ returns the action `player` took in `round`, or None if they haven't acted """
+        return self.actions_by(round).get(player.id)
+
+    def add_action(self, action):
+        if action not in self.actions:
+            self._link_action(action)
+            self.actions.append(action)
+        # an existing action may have been given a new target, so rebuild the indexes either way
+        self._indexes = {}
+
+    def yet_to_vote(self, round, is_alive=True):
+        """ return alive (or dead, if `is_alive` is False) players who have not voted in this round
+        """
+        actions_by = self.actions_by(round)
+        return [x for x in self.players
+                if (x.died_in_round is None) == is_alive and x.id not in actions_by]
+
+    @property
+    def endgame_type(self):
+        """ returns 'bad' if bad guys win, 'good' if good guys win else None """
+        if not self.game.date_started:
+            return None
+
+        num_bad  = len(self.list_bad_guys())
+        num_good = len(self.list_good_guys())
+
+        if num_bad == 0:
+            return 'good'
+        if num_bad > num_good:
+            return 'bad'
+        if num_bad == 1 and num_good == 1:
+            return 'truce'
+        return None
+
+    @property
+    def state_token(self):
+        """ returns a string representing the state of the game """
+        return make_state_token(self.game.id, self.game.version)
+
+
+def _snapshot_cache_key(game_id, version):
+    return 'game-snapshot-{}-{}'.format(game_id, version)
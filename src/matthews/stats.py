@@ -0,0 +1,99 @@
+""" works out the statistics shown for each player at the end of a game """
+from django.db.models import Count, F, Q
+
+from .models import Action, MAFIA_ID, CIVILIAN_ID, DOCTOR_ID, DETECTIVE_ID
+
+BAD_GUY_IDS  = [MAFIA_ID]
+GOOD_GUY_IDS = [CIVILIAN_ID, DOCTOR_ID, DETECTIVE_ID]
+
+COUNTED_STATS = ['lynched_bad', 'lynched_good', 'killed_bad', 'killed_good', 'killed_doctor',
+                 'killed_detective', 'lives_saved', 'mafia_target', 'mafia_found']
+STATS = COUNTED_STATS + ['suspected_bad_pc', 'successful_kill_pc']
+
+
+def was_alive(player, round):
+    return player.died_in_round is None or round <= player.died_in_round
+
+
+def count_bad_guys_suspected(players, before_round=None):
+    """ returns {player id: number of nights they picked out a bad guy while alive} for all of
+        `players` in one grouped query, optionally only counting nights before `before_round`
+    """
+    actions = Action.objects.filter(done_by__in=players, is_night=True, done_to__character_id__in=BAD_GUY_IDS) \
+                            .filter(Q(round__lte=F('done_by__died_in_round')) | Q(done_by__died_in_round__isnull=True))
+    if before_round is not None:
+        actions = actions.filter(round__lt=before_round)
+    counts = actions.values('done_by_id').annotate(num=Count('id')).values_list('done_by_id', 'num')
+    return dict(counts)
+
+
+def add_endgame_stats(game, players, round):
+    """ decorates each of the game's `players` with their end-of-game stats, working them all out
+        in one pass over one flat query of the game's actions, plus one for civilians' suspicions
+    """
+    players_by_id = {x.id: x for x in players}
+    actions = list(Action.objects.filter(game=game).values_list('round', 'done_by_id', 'done_to_id'))
+
+    # (round, player id) of everyone the bad guys went after, so we can tell if a doctor saved them
+    bad_guy_targets = {(action_round, done_to_id)
+                       for action_round, done_by_id, done_to_id in actions
+                       if done_to_id and players_by_id[done_by_id].character_id in BAD_GUY_IDS}
+    saved_rounds = {x.id: set() for x in players}
+    suspected_bad = count_bad_guys_suspected([x for x in players if x.character_id == CIVILIAN_ID])
+    for player in players:
+        for stat in COUNTED_STATS:
+            setattr(player, stat, 0)
+
+    for action_round, done_by_id, done_to_id in actions:
+        done_by  = players_by_id[done_by_id]
+        done_to  = players_by_id.get(done_to_id)
+        is_night = action_round % 2 == 1
+        if not done_to:
+            continue
+
+        target_is_bad  = done_to.character_id in BAD_GUY_IDS
+        target_is_good = done_to.character_id in GOOD_GUY_IDS
+        target_died    = done_to.died_in_round == action_round
+
+        if is_night and done_by.character_id in BAD_GUY_IDS and was_alive(done_to, action_round):
+            done_to.mafia_target += 1
+
+        if not was_alive(done_by, action_round):
+            continue
+
+        if not is_night:
+            if target_died:
+                done_by.lynched_bad  += target_is_bad
+                done_by.lynched_good += target_is_good
+        elif done_by.character_id == MAFIA_ID:
+            if target_died:
+                done_by.killed_bad       += target_is_bad
+                done_by.killed_good      += target_is_good
+                done_by.killed_doctor    += done_to.character_id == DOCTOR_ID
+                done_by.killed_detective += done_to.character_id == DETECTIVE_ID
+        elif done_by.character_id == DOCTOR_ID:
+            if (action_round, done_to_id) in bad_guy_targets:
+                saved_rounds[done_by_id].add(action_round)
+        elif done_by.character_id == DETECTIVE_ID:
+            done_by.mafia_found += target_is_bad
+
+    for player in players:
+        player.lives_saved = len(saved_rounds[player.id])
+        died_or_now = player.died_in_round if player.died_in_round is not None else round
+        player.suspected_bad_pc = suspected_bad.get(player.id, 0) / (died_or_now + 1) * 2 * 100
+        # this doesn't seem to take into account if mafia was alive
+        kill_rounds = player.died_in_round + 1 if player.died_in_round is not None else round
+        player.successful_kill_pc = player.killed_good / kill_rounds * 2 * 100 if kill_rounds else None
+
+
+def make_endgame_results(game, players, round):
+    """ returns each player's end-of-game stats keyed by player id, ready to store in `game.results` """
+    add_endgame_stats(game, players, round)
+    return {str(x.id): {stat: getattr(x, stat) for stat in STATS} for x in players}
+
+
+def add_endgame_results(players, results):
+    """ decorates `players` with the stats stored in a finished game's `results` """
+    for player in players:
+        for stat, value in results.get(str(player.id), {}).items():
+            setattr(player, stat, value)
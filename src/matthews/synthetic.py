@@ -0,0 +1,75 @@
+""" builds and plays games without real players, for tests, benchmarks and load testing """
+import random
+
+from . import events
+from .models import Character, Game, Player, ROLE_NAMES, MAFIA_ID, CIVILIAN_ID, DOCTOR_ID, DETECTIVE_ID
+from .snapshot import GameSnapshot
+from .views import save_action
+
+
+def make_characters():
+    """ makes sure there's a character for each role, as a fresh database has none """
+    for id, name in ROLE_NAMES.items():
+        Character.objects.get_or_create(id=id, name=name)
+
+
+def make_game(num_players, num_mafia=None, started=True):
+    """ returns a game of `num_players` with a doctor, a detective and a quarter mafia, or with
+        no roles handed out yet if not `started`
+    """
+    make_characters()
+    num_mafia = num_mafia or max(1, num_players // 4)
+    character_ids = [MAFIA_ID] * num_mafia + [DOCTOR_ID, DETECTIVE_ID]
+    character_ids += [CIVILIAN_ID] * (num_players - len(character_ids))
+    game = Game.objects.create(date_started='2020-01-01T00:00Z' if started else None)
+    Player.objects.bulk_create([Player(game=game, name='P{}'.format(i), character_id=character_id if started else None)
+                                for i, character_id in enumerate(character_ids)])
+    # logged as the views would have, so the game can be replayed from its events
+    players = list(game.players.order_by('id'))
+    log = [(events.JOINED, {'player_id': x.id, 'name': x.name}) for x in players]
+    if started:
+        log.append((events.STARTED, {'roles': [[x.id, x.character_id] for x in players]}))
+    events.record_many(game, log)
+    return game
+
+
+def random_target(snapshot, player, rng):
+    """ anyone, or no-one """
+    return rng.choice(snapshot.players + [None])
+
+
+def decisive_target(snapshot, player, rng):
+    """ the whole town lynches the same player each day and the mafia agree on a victim each
+        night, so someone usually dies every round and games reach their end quickly
+    """
+    round = snapshot.round
+    agreed = random.Random('{}-{}'.format(snapshot.game.id, round))
+    if round % 2 == 0:
+        return agreed.choice(snapshot.alive_players())
+    if player.character_id == MAFIA_ID:
+        return agreed.choice(snapshot.list_good_guys())
+    return rng.choice(snapshot.alive_players())
+
+
+def play_game(game, rng, max_rounds=100, choose_target=random_target):
+    """ casts actions picked by `choose_target` for every player until the game ends (or
+        `max_rounds` pass)
+    """
+    for _ in range(max_rounds):
+        snapshot = GameSnapshot(Game.objects.get(id=game.id))
+        if snapshot.endgame_type:
+            break
+        round = snapshot.round
+        for player in snapshot.yet_to_vote(round):
+            save_action(snapshot, player, choose_target(snapshot, player, rng))
+    game.refresh_from_db()
+    return game
+
+
+def login(client, player):
+    """ puts `player`'s ids into `client`'s session, as following their invite link would """
+    session = client.session
+    session['game_id']   = player.game_id
+    session['player_id'] = player.id
+    session.save()
+    return client
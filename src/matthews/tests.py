@@ -1,3 +1,834 @@
-from django.test import TestCase
+import os
+import random
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from io import StringIO
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.conf import settings
+from django.core import mail
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.core.mail.backends.base import BaseEmailBackend
+from django.core.mail.backends.locmem import EmailBackend as LocmemEmailBackend
+from django.db import connection
+from django.db.models import Count, Q, F, FloatField
+from django.db.models.functions import Cast, Coalesce
+from django.test import Client, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from project import metrics, profiling
+from project.emails import queue_email, send_queued_emails
+from .archive import archive_games, find_archivable_games, load_archived_game
+from .models import *
+from .snapshot import GameSnapshot
+from .stats import add_endgame_stats, count_bad_guys_suspected, make_endgame_results, STATS
+from .death_reports import make_death_report
+from .synthetic import make_game, play_game, login, decisive_target
+from . import events, versions, views
+from .versions import bump_version, get_version, make_state_token, publish_version, wait_for_change
+from .views import save_action, who_died
+
+
+def commit_immediately():
+    """ TestCase never commits, so this runs on_commit callbacks (like publishing a game's new
+        version to the cache) straight away instead
+    """
+    return mock.patch('django.db.transaction.on_commit', lambda callback: callback())
+
+
+def endgame_stats_query(game, round):
+    """ the ORM query the end-of-game stats used to be worked out with, kept to check parity """
+    bad_guy_ids = [MAFIA_ID]
+    good_guy_ids = [CIVILIAN_ID, DOCTOR_ID, DETECTIVE_ID]
+    day_regex   = r'^\d*[02468]$'
+    night_regex = r'^\d*[13579]$'
+    was_alive_to_act         = Q(actions_by__round__lte=F('died_in_round')) | Q(died_in_round__isnull=True)
+    was_alive_to_be_acted_on = Q(actions_to__round__lte=F('died_in_round')) | Q(died_in_round__isnull=True)
+    players = game.players.order_by('id').annotate(lynched_bad=Count('actions_by', distinct=True,
+                                                 filter=Q(was_alive_to_act,
+                                                          actions_by__round__iregex=day_regex,
+                                                          actions_by__done_to__character_id__in=bad_guy_ids,
+                                                          actions_by__done_to__died_in_round=F('actions_by__round')))
+                    ).annotate(lynched_good=Count('actions_by', distinct=True,
+                                                  filter=Q(was_alive_to_act,
+                                                           actions_by__round__iregex=day_regex,
+                                                           actions_by__done_to__character_id__in=good_guy_ids,
+                                                           actions_by__done_to__died_in_round=F('actions_by__round')))
+                    ).annotate(killed_bad=Count('actions_by', distinct=True,
+                                                filter=Q(was_alive_to_act,
+                                                         character_id=MAFIA_ID,
+                                                         actions_by__round__iregex=night_regex,
+                                                         actions_by__done_to__character_id__in=bad_guy_ids,
+                                                         actions_by__done_to__died_in_round=F('actions_by__round')))
+                    ).annotate(killed_good=Count('actions_by', distinct=True,
+                                                 filter=Q(was_alive_to_act,
+                                                          character_id=MAFIA_ID,
+                                                          actions_by__round__iregex=night_regex,
+                                                          actions_by__done_to__character_id__in=good_guy_ids,
+                                                          actions_by__done_to__died_in_round=F('actions_by__round')))
+                    ).annotate(killed_doctor=Count('actions_by', distinct=True,
+                                                 filter=Q(was_alive_to_act,
+                                                          character_id=MAFIA_ID,
+                                                          actions_by__round__iregex=night_regex,
+                                                          actions_by__done_to__character_id=DOCTOR_ID,
+                                                          actions_by__done_to__died_in_round=F('actions_by__round')))
+                    ).annotate(killed_detective=Count('actions_by', distinct=True,
+                                                 filter=Q(was_alive_to_act,
+                                                          character_id=MAFIA_ID,
+                                                          actions_by__round__iregex=night_regex,
+                                                          actions_by__done_to__character_id=DETECTIVE_ID,
+                                                          actions_by__done_to__died_in_round=F('actions_by__round')))
+                    ).annotate(lives_saved=Count('actions_by__round', distinct=True,
+                                                 filter=Q(was_alive_to_act,
+                                                          character_id=DOCTOR_ID,
+                                                          actions_by__round__iregex=night_regex,
+                                                          actions_by__done_to__actions_to__done_by__character_id__in=bad_guy_ids,
+                                                          actions_by__done_to__actions_to__round=F('actions_by__round')))
+                    ).annotate(suspected_bad_pc=Cast(Count('actions_by', distinct=True,
+                                                           filter=Q(was_alive_to_act,
+                                                                    character_id=CIVILIAN_ID,
+                                                                    actions_by__round__iregex=night_regex,
+                                                                    actions_by__done_to__character_id__in=bad_guy_ids)), FloatField())
+                                                / Cast(Coalesce(F('died_in_round'), round) + 1 , FloatField())
+                                                * 2 * 100
+                    ).annotate(successful_kill_pc=Cast(F('killed_good'), FloatField())
+                                                / Cast(Coalesce(F('died_in_round') + 1, round) , FloatField())
+                                                * 2 * 100
+                              # this doesn't seem to take into account if mafia was alive
+                    ).annotate(mafia_target=Count('actions_to', distinct=True,
+                                                 filter=Q(was_alive_to_be_acted_on,
+                                                          actions_to__round__iregex=night_regex,
+                                                          actions_to__done_by__character_id__in=bad_guy_ids))
+                    ).annotate(mafia_found=Count('actions_by', distinct=True,
+                                                filter=Q(was_alive_to_act,
+                                                         character_id=DETECTIVE_ID,
+                                                         actions_by__round__iregex=night_regex,
+                                                         actions_by__done_to__character_id__in=bad_guy_ids))
+    )
+    return list(players)
+
+
+class EndgameStatsTest(TestCase):
+
+    def test_stats_match_orm_query(self):
+        rng = random.Random(1)
+        for num_players in [4, 5, 7, 10, 15]:
+            for _ in range(3):
+                game = play_game(make_game(num_players), rng)
+                expected = endgame_stats_query(game, game.round)
+                players = list(game.players.order_by('id'))
+                add_endgame_stats(game, players, game.round)
+                for player, expected_player in zip(players, expected):
+                    for stat in STATS:
+                        self.assertAlmostEqual(getattr(player, stat), getattr(expected_player, stat),
+                                               msg='{} of {}'.format(stat, player))
+
+    def test_suspicions_match_per_player_queries(self):
+        game = play_game(make_game(10), random.Random(5))
+        players = list(game.players.filter(died_in_round__isnull=False))
+        for before_round in range(1, game.round + 1):
+            counts = count_bad_guys_suspected(players, before_round)
+            for player in players:
+                expected = player.actions_by.filter(round__iregex=r'^\d*[13579]$', round__lt=before_round,
+                                                    round__lte=player.died_in_round,
+                                                    done_to__character_id=MAFIA_ID).count()
+                self.assertEqual(counts.get(player.id, 0), expected)
+
+    def test_stats_take_two_queries(self):
+        game = play_game(make_game(12), random.Random(2))
+        players = list(game.players.order_by('id'))
+        with self.assertNumQueries(2):
+            add_endgame_stats(game, players, game.round)
+
+
+class EndgameResultsTest(TestCase):
+
+    def test_stored_in_the_round_which_ends_the_game(self):
+        rng  = random.Random(4)
+        game = make_game(8)
+        while True:
+            game = play_game(game, rng, max_rounds=1, choose_target=decisive_target)
+            if GameSnapshot(game).endgame_type:
+                break
+            self.assertResultsCleared(game)
+
+        players = list(game.players.order_by('id'))
+        self.assertEqual(game.results, make_endgame_results(game, players, game.round))
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+                       STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+    def test_finished_game_page_uses_stored_results(self):
+        game = play_game(make_game(8), random.Random(4), choose_target=decisive_target)
+        client = login(Client(), game.players.order_by('id').first())
+        cache.clear()
+        with mock.patch('matthews.stats.add_endgame_stats', side_effect=AssertionError('stats recounted')):
+            response = client.get(reverse('matthews:game'))
+        self.assertEqual(response.status_code, 200)
+        for player in response.context['players']:
+            for stat in STATS:
+                self.assertEqual(getattr(player, stat), game.results[str(player.id)][stat])
+
+    def test_cleared_by_restarts(self):
+        game = play_game(make_game(8), random.Random(4), choose_target=decisive_target)
+        self.assertTrue(game.results)
+        leader = login(Client(), game.players.order_by('id').first())
+
+        leader.get(reverse('matthews:restart_round', kwargs={'round': game.round - 1}))
+        self.assertResultsCleared(game)
+
+        game = play_game(game, random.Random(4), choose_target=decisive_target)
+        self.assertTrue(game.results)
+        leader.get(reverse('matthews:restart'))
+        self.assertResultsCleared(game)
+
+    def assertResultsCleared(self, game):
+        # DictField loads a NULL as {}, so check what's actually stored
+        self.assertTrue(Game.objects.filter(id=game.id, results__isnull=True).exists())
+
+
+class RoundCounterTest(TestCase):
+
+    def assertRoundCounted(self, game):
+        game = Game.objects.get(id=game.id)
+        self.assertEqual((game.round, game.round_actions), game.count_round())
+
+    def test_write_paths_keep_round_counted(self):
+        game = play_game(make_game(8), random.Random(4), max_rounds=3)
+        self.assertRoundCounted(game)
+        game.refresh_from_db()
+        voter = game.players.filter(died_in_round__isnull=True).order_by('id').first()
+        client = login(Client(), voter)
+
+        client.post(reverse('matthews:target'), {'round': game.round, 'target': 0})
+        self.assertTrue(Action.objects.filter(game=game, round=game.round, done_by=voter).exists())
+        self.assertRoundCounted(game)
+        client.post(reverse('matthews:target'), {'round': game.round, 'cancel': 1})
+        self.assertFalse(Action.objects.filter(game=game, round=game.round, done_by=voter).exists())
+        self.assertRoundCounted(game)
+
+        leader = login(Client(), game.players.order_by('id').first())
+        leader.get(reverse('matthews:restart_round', kwargs={'round': 1}))
+        self.assertRoundCounted(game)
+
+        pre_start = make_game(6, started=False)
+        leader = login(Client(), pre_start.players.order_by('id').first())
+        leader.get(reverse('matthews:remove_player', kwargs={'id': pre_start.players.order_by('id').last().id}))
+        self.assertRoundCounted(pre_start)
+
+    def test_check_rounds_reports_and_fixes(self):
+        game = play_game(make_game(8), random.Random(5), max_rounds=2)
+        other = play_game(make_game(6), random.Random(6), max_rounds=2)
+        Game.objects.filter(id=game.id).update(round=F('round') + 3, round_actions=1)
+        version = Game.objects.get(id=game.id).version
+
+        out = StringIO()
+        call_command('check_rounds', stdout=out)
+        self.assertIn('{} stores round'.format(game), out.getvalue())
+        self.assertNotIn('{} stores round'.format(other), out.getvalue())
+        self.assertIn('1 inconsistent games', out.getvalue())
+
+        call_command('check_rounds', '--fix', stdout=StringIO())
+        self.assertRoundCounted(game)
+        self.assertEqual(Game.objects.get(id=game.id).version, version + 1)
+
+
+class BulkWriteQueriesTest(TestCase):
+    """ each of these writes should cost the same number of queries however many players there are """
+
+    def assertQueriesIndependentOfPlayers(self, prepare, sizes=(5, 30)):
+        """ `prepare` is given a game of each size and returns the write to count queries for """
+        counts = []
+        for num_players in sizes:
+            write = prepare(make_game(num_players))
+            with CaptureQueriesContext(connection) as queries:
+                write()
+            counts.append(len(queries))
+        self.assertEqual(len(set(counts)), 1, counts)
+
+    def test_start(self):
+        def prepare(game):
+            game.date_started = None
+            game.options = {'roles': {MAFIA_ID: {'min': 1, 'pc': 25}, DOCTOR_ID: {'min': 1, 'pc': 10}}}
+            game.save()
+            client = login(Client(), game.players.order_by('id').first())
+            return lambda: client.get(reverse('matthews:start'))
+        self.assertQueriesIndependentOfPlayers(prepare)
+
+    def test_restart(self):
+        def prepare(game):
+            play_game(game, random.Random(3), max_rounds=4)
+            client = login(Client(), game.players.order_by('id').first())
+            return lambda: client.get(reverse('matthews:restart'))
+        self.assertQueriesIndependentOfPlayers(prepare)
+
+    def test_restart_round(self):
+        def prepare(game):
+            play_game(game, random.Random(4), max_rounds=4)
+            client = login(Client(), game.players.order_by('id').first())
+            return lambda: client.get(reverse('matthews:restart_round', kwargs={'round': 1}))
+        self.assertQueriesIndependentOfPlayers(prepare)
+
+    def test_corpse_votes(self):
+        def prepare(game):
+            players = list(game.players.order_by('id'))
+            game.players.exclude(id__in=[players[0].id, players[1].id]).update(died_in_round=0)
+            snapshot = GameSnapshot(Game.objects.get(id=game.id))
+            save_action(snapshot, players[0], None)
+            return lambda: save_action(snapshot, players[1], None)
+        self.assertQueriesIndependentOfPlayers(prepare)
+
+
+class FailingEmailBackend(BaseEmailBackend):
+    def send_messages(self, email_messages):
+        raise ConnectionError('SMTP server went away')
+
+
+class CountingEmailBackend(LocmemEmailBackend):
+    num_opened = 0
+
+    def open(self):
+        CountingEmailBackend.num_opened += 1
+
+
+@override_settings(BLOCK_EMAIL_SENDING=False, IS_PRODUCTION=True, SEND_ALL_EMAILS_TO=None)
+class EmailQueueTest(TestCase):
+
+    def queue(self, num_emails):
+        for i in range(num_emails):
+            queue_email(['p{}@example.com'.format(i)], 'Join Matthews Game', html_content='hi', text_content='hi')
+
+    @override_settings(EMAIL_BACKEND='matthews.tests.CountingEmailBackend')
+    def test_sends_batches_over_one_connection(self):
+        self.queue(5)
+        self.assertEqual(len(mail.outbox), 0)
+
+        CountingEmailBackend.num_opened = 0
+        self.assertEqual(send_queued_emails(batch_size=3), 3)
+        self.assertEqual(CountingEmailBackend.num_opened, 1)
+        self.assertEqual(send_queued_emails(batch_size=3), 2)
+        self.assertEqual(send_queued_emails(batch_size=3), 0)
+
+        self.assertEqual(sorted(x.to[0] for x in mail.outbox), ['p{}@example.com'.format(i) for i in range(5)])
+        self.assertFalse(QueuedEmail.objects.filter(date_sent__isnull=True).exists())
+
+    @override_settings(EMAIL_BACKEND='matthews.tests.FailingEmailBackend')
+    def test_retries_failures_with_backoff(self):
+        self.queue(1)
+        self.assertEqual(send_queued_emails(batch_size=10), 1)
+        queued = QueuedEmail.objects.get()
+        self.assertEqual(queued.attempts, 1)
+        self.assertIn('SMTP server went away', queued.last_error)
+        self.assertIsNone(queued.date_sent)
+
+        # not due again until its backoff has passed
+        self.assertEqual(send_queued_emails(batch_size=10), 0)
+        QueuedEmail.objects.update(next_attempt=queued.date_queued)
+        with self.settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend'):
+            self.assertEqual(send_queued_emails(batch_size=10), 1)
+        self.assertEqual(len(mail.outbox), 1)
+
+
+@skipUnless(connection.features.has_select_for_update, 'needs a database with row locks, eg Postgres')
+class ConcurrentVotesTest(TransactionTestCase):
+
+    def cast_simultaneously(self, votes):
+        """ posts each (player, target) vote from its own thread, all at once """
+        clients = [(login(Client(), player), target) for player, target in votes]
+        barrier = threading.Barrier(len(clients))
+        errors  = []
+
+        def vote(client, target):
+            try:
+                barrier.wait()
+                response = client.post(reverse('matthews:target'), {'round': 0, 'target': target.id})
+                self.assertEqual(response.status_code, 302)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=vote, args=x) for x in clients]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def test_last_votes_resolve_round_once(self):
+        for num_last_votes in [2, 4, 8]:
+            game = make_game(8)
+            players = list(game.players.order_by('id'))
+            victim = players[-1]
+            snapshot = GameSnapshot(game)
+            for player in players[:-num_last_votes]:
+                save_action(snapshot, player, victim)
+
+            self.cast_simultaneously([(x, victim) for x in players[-num_last_votes:]])
+
+            game.refresh_from_db()
+            self.assertEqual((game.round, game.round_actions), (1, 0))
+            self.assertEqual(game.count_round(), (1, 0))
+            self.assertEqual(list(game.players.filter(died_in_round__isnull=False)), [victim])
+
+
+@override_settings(MIDDLEWARE=['project.profiling.ProfilingMiddleware'] + settings.MIDDLEWARE,
+                   CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class ProfilingMiddlewareTest(TestCase):
+
+    def setUp(self):
+        profiling.reset_request_stats()
+        self.client = login(Client(), make_game(5).players.first())
+
+    def test_records_each_view(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('matthews:state'))
+        self.client.get(reverse('matthews:state'))
+
+        stats = profiling.get_request_stats()['matthews:state']
+        self.assertEqual(stats['wall_ms']['count'], 2)
+        self.assertEqual(stats['queries']['count'], 2)
+        self.assertGreaterEqual(stats['queries']['sum'], len(queries))
+        self.assertEqual(stats['bytes']['sum'], 2 * len(self.client.get(reverse('matthews:state')).content))
+
+    def test_profiles_sampled_views(self):
+        with tempfile.TemporaryDirectory() as profile_dir:
+            with self.settings(PROFILE_VIEWS=['matthews:state'], PROFILE_SAMPLE_RATE=1, PROFILE_DIR=profile_dir):
+                self.client.get(reverse('matthews:state'))
+                self.client.get(reverse('matthews:wait'), {'token': ''})
+            self.assertEqual([x.split('-')[:2] for x in os.listdir(profile_dir)], [['matthews', 'state']])
+
+
+@override_settings(METRICS_ENABLED=True, CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class MetricsTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_counts_game_engine_events(self):
+        game = make_game(8)
+        game.date_started = timezone.now()
+        game.save()
+        client = login(Client(), game.players.first())
+        play_game(game, random.Random(5), max_rounds=2)
+        self.assertFalse(game.results)
+        etag = client.get(reverse('matthews:state'))['ETag']
+        client.get(reverse('matthews:state'), HTTP_IF_NONE_MATCH=etag)
+
+        lines = metrics.render_metrics().splitlines()
+        num_players = game.players.count()
+        self.assertIn('matthews_rounds_resolved_total 2', lines)
+        self.assertIn('matthews_votes_total {}'.format(2 * num_players), lines)
+        self.assertIn('matthews_polls_total 2', lines)
+        self.assertIn('matthews_polls_unchanged_total 1', lines)
+        self.assertIn('matthews_who_died_seconds_count 2', lines)
+        self.assertIn('matthews_who_died_seconds_bucket{le="+Inf"} 2', lines)
+        self.assertIn('matthews_active_games 1', lines)
+
+    @override_settings(METRICS_ENABLED=False)
+    def test_counts_nothing_when_disabled(self):
+        play_game(make_game(5), random.Random(5), max_rounds=1)
+        with self.settings(METRICS_ENABLED=True):
+            self.assertIn('matthews_votes_total 0', metrics.render_metrics().splitlines())
+
+
+@commit_immediately()
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class StateTokenTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def get_state(self, client, etag=None):
+        headers = {'HTTP_IF_NONE_MATCH': etag} if etag else {}
+        return client.get(reverse('matthews:state'), **headers)
+
+    def test_matching_etag_gets_304(self):
+        client = login(Client(), make_game(5).players.first())
+        response = self.get_state(client)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        self.assertEqual(etag, '"{}"'.format(response.content.decode()))
+
+        response = self.get_state(client, etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+    def test_304_only_reads_the_version(self):
+        game = play_game(make_game(8), random.Random(1), max_rounds=2)
+        client = login(Client(), game.players.first())
+        etag = self.get_state(client)['ETag']
+        cache.delete(versions._version_cache_key(game.id))
+        with CaptureQueriesContext(connection) as queries:
+            response = self.get_state(client, etag)
+        self.assertEqual(response.status_code, 304)
+        game_queries = [x['sql'] for x in queries if 'django_session' not in x['sql']]
+        self.assertEqual(len(game_queries), 1, game_queries)
+        self.assertIn('"version"', game_queries[0])
+
+    def assertWriteChangesToken(self, client, write):
+        etag = self.get_state(client)['ETag']
+        write()
+        response = self.get_state(client, etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_vote_changes_token(self):
+        player = make_game(5).players.order_by('id').first()
+        client = login(Client(), player)
+        self.assertWriteChangesToken(client, lambda: client.post(reverse('matthews:target'),
+                                                                 {'round': 0, 'target': 0}))
+
+    def test_join_and_options_change_token(self):
+        game = make_game(5, started=False)
+        client = login(Client(), game.players.order_by('id').first())
+        kwargs = {'id': game.id, 'name': 'Newcomer', 'hash': views.make_invite_hash(game.id, 'Newcomer')}
+        self.assertWriteChangesToken(client, lambda: Client().get(reverse('matthews:join', kwargs=kwargs)))
+        self.assertWriteChangesToken(client, lambda: client.post(reverse('matthews:update_options'), {
+            'character_ids[]': [str(MAFIA_ID)], 'min_{}'.format(MAFIA_ID): 1, 'pc_{}'.format(MAFIA_ID): 25}))
+
+
+@commit_immediately()
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+                   LONG_POLL_SECONDS=5, LONG_POLL_CHECK_SECONDS=5)
+class WaitTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.game   = make_game(5)
+        self.client = login(Client(), self.game.players.first())
+        self.token  = make_state_token(self.game.id, get_version(self.game.id))
+
+    def wait(self, token):
+        start = time.monotonic()
+        response = self.client.get(reverse('matthews:wait'), {'token': token})
+        self.assertEqual(response.status_code, 200)
+        return response.content.decode(), time.monotonic() - start
+
+    def test_stale_token_returns_straight_away(self):
+        token, elapsed = self.wait('stale')
+        self.assertEqual(token, self.token)
+        self.assertLess(elapsed, 1)
+
+    @override_settings(LONG_POLL_SECONDS=0.2)
+    def test_current_token_returned_after_timeout(self):
+        token, elapsed = self.wait(self.token)
+        self.assertEqual(token, self.token)
+        self.assertGreaterEqual(elapsed, 0.2)
+
+    def test_write_wakes_waiters(self):
+        result = {}
+
+        def wait():
+            start = time.monotonic()
+            result['token'] = wait_for_change(self.game.id, self.token, 5)
+            result['elapsed'] = time.monotonic() - start
+
+        waiter = threading.Thread(target=wait)
+        waiter.start()
+        time.sleep(0.1)
+        bump_version(self.game)
+        waiter.join(5)
+        self.assertEqual(result['token'], make_state_token(self.game.id, get_version(self.game.id)))
+        self.assertNotEqual(result['token'], self.token)
+        self.assertLess(result['elapsed'], 2)
+
+    @override_settings(LONG_POLL_MAX_WAITERS=1)
+    def test_waiters_past_the_cap_are_sent_to_poll(self):
+        with versions.waiter_slot() as claimed:
+            self.assertTrue(claimed)
+            response = self.client.get(reverse('matthews:wait'), {'token': self.token})
+            self.assertEqual(response.status_code, 503)
+        # the slot is given back once its waiter is done
+        token, _ = self.wait('stale')
+        self.assertEqual(token, self.token)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class VersionCacheTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_late_reader_cant_overwrite_published_version(self):
+        game  = make_game(4)
+        stale = get_version(game.id)
+        cache.clear()
+        bump_version(game)
+        read_version = versions._read_version
+
+        def read_then_commit(game_id):
+            # the writer commits and publishes between this reader's query and its cache write
+            with mock.patch('matthews.versions._read_version', read_version):
+                publish_version(game_id)
+            return stale
+
+        with mock.patch('matthews.versions._read_version', read_then_commit):
+            self.assertEqual(get_version(game.id), stale)
+        self.assertEqual(get_version(game.id), stale + 1)
+
+    def test_version_is_only_replaced_on_commit(self):
+        game = make_game(4)
+        version = get_version(game.id)
+        bump_version(game)
+        # still in the writer's transaction, so readers elsewhere can't see the new version yet
+        self.assertEqual(get_version(game.id), version)
+        publish_version(game.id)
+        self.assertEqual(get_version(game.id), version + 1)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class SessionTest(TestCase):
+
+    def test_polling_reads_session_from_cache_and_never_writes_it(self):
+        client = login(Client(), make_game(5).players.first())
+        client.get(reverse('matthews:state'))
+        for url in [reverse('matthews:state'), reverse('matthews:wait') + '?token=']:
+            with CaptureQueriesContext(connection) as queries:
+                response = client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual([x['sql'] for x in queries if 'django_session' in x['sql']], [])
+            self.assertNotIn(settings.SESSION_COOKIE_NAME, response.cookies)
+
+
+@commit_immediately()
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+                   STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class FragmentCacheTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_shared_sections_render_once_per_state(self):
+        game = make_game(8)
+        play_game(game, random.Random(2), max_rounds=1)
+        players = list(game.players.filter(died_in_round__isnull=True).order_by('id'))
+
+        def view_game(player):
+            response = login(Client(), player).get(reverse('matthews:game'))
+            self.assertEqual(response.status_code, 200)
+            return response.content.decode()
+
+        with mock.patch('matthews.views.get_vote_tallies', wraps=views.get_vote_tallies) as get_votes:
+            pages = [view_game(x) for x in players]
+            self.assertEqual(get_votes.call_count, 1)
+            self.assertTrue(all('The voting broke down as follows' in x for x in pages))
+
+            save_action(GameSnapshot(Game.objects.get(id=game.id)), players[0], None)
+            view_game(players[1])
+            self.assertEqual(get_votes.call_count, 2)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+                   STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class GamePageQueriesTest(TestCase):
+    """ the game page should load each player's character and target from memory, not one at a time """
+
+    def assertQueriesIndependentOfPlayers(self, max_rounds, sizes=(6, 20)):
+        counts = []
+        for num_players in sizes:
+            game = play_game(make_game(num_players), random.Random(1), max_rounds=max_rounds)
+            client = login(Client(), game.players.filter(died_in_round__isnull=True).order_by('id').first())
+            cache.clear()
+            with CaptureQueriesContext(connection) as queries:
+                response = client.get(reverse('matthews:game'))
+            self.assertEqual(response.status_code, 200)
+            counts.append(len(queries))
+        self.assertEqual(len(set(counts)), 1, counts)
+
+    def test_mid_game(self):
+        self.assertQueriesIndependentOfPlayers(max_rounds=2)
+
+    def test_endgame(self):
+        self.assertQueriesIndependentOfPlayers(max_rounds=1000)
+
+
+class SnapshotIndexTest(TestCase):
+
+    def test_indexes_match_actions(self):
+        game = play_game(make_game(12), random.Random(3), max_rounds=3)
+        snapshot = GameSnapshot(Game.objects.get(id=game.id))
+        for round in [game.round - 1, game.round]:
+            actions = snapshot.actions_in_round(round)
+            self.assertEqual(snapshot.actions_by(round), {x.done_by_id: x for x in actions})
+            for target_id, targeting in snapshot.actions_to(round).items():
+                self.assertEqual(targeting, [x for x in actions if x.done_to_id == target_id])
+
+    def test_changed_vote_is_reindexed(self):
+        game = make_game(6)
+        snapshot = GameSnapshot(Game.objects.get(id=game.id))
+        voter, first, second = snapshot.players[:3]
+        save_action(snapshot, voter, first)
+        self.assertEqual(snapshot.actions_to(0)[first.id][0].done_by_id, voter.id)
+        save_action(snapshot, voter, second)
+        self.assertNotIn(first.id, snapshot.actions_to(0))
+        self.assertEqual(snapshot.get_action(voter, 0).done_to_id, second.id)
+
+
+class WhoDiedTest(TestCase):
+
+    def assertDied(self, game, round, targets, expected):
+        """ `targets` maps the index of each player who acts to the index of their target (or None) """
+        snapshot = GameSnapshot(game)
+        players  = snapshot.players
+        actions  = [Action(game=game, round=round, done_by=players[by], done_to=None if to is None else players[to])
+                    for by, to in targets.items()]
+        snapshot = GameSnapshot(game, players, actions)
+        with self.assertNumQueries(0):
+            victims = who_died(snapshot, round)
+        self.assertEqual(victims, [players[x] for x in expected])
+
+    def test_day_majority(self):
+        game = make_game(8)
+        self.assertDied(game, 0, {0: 1, 1: 2, 2: 4, 3: 4, 4: 5, 5: 4, 6: 4, 7: 4}, [4])
+        self.assertDied(game, 0, {0: 1, 1: 2, 2: 4, 3: 4, 4: 5, 5: 4, 6: 3, 7: 3}, [])
+
+    def test_day_good_guy_consensus(self):
+        # mafia 0-2, doctor 3, detective 4 and a civilian 5, so three good votes aren't a majority
+        game = make_game(6, num_mafia=3)
+        self.assertDied(game, 0, {0: None, 1: None, 2: None, 3: 0, 4: 0, 5: 0}, [0])
+
+    def test_night_doctor_save(self):
+        game = make_game(8)
+        self.assertDied(game, 1, {0: 4, 1: 4, 2: 5, 3: 6}, [4])
+        self.assertDied(game, 1, {0: 4, 1: 4, 2: 4, 3: 6}, [])
+
+    def test_night_needs_consensus_to_win(self):
+        # mafia 0-2 against doctor, detective and a civilian
+        game = make_game(6, num_mafia=3)
+        self.assertDied(game, 1, {0: 5, 1: 5, 2: None}, [])
+        self.assertDied(game, 1, {0: 5, 1: 5, 2: 5}, [5])
+
+
+class EventLogTest(TestCase):
+
+    def test_replay_matches_tables(self):
+        game = play_game(make_game(10), random.Random(6), max_rounds=4)
+        self.assertEqual(events.verify(game), [])
+
+        players = list(game.players.filter(died_in_round__isnull=True).order_by('id'))
+        client = login(Client(), players[0])
+        client.post(reverse('matthews:target'), {'round': game.round, 'target': players[1].id})
+        client.post(reverse('matthews:target'), {'round': game.round, 'cancel': 1})
+        client.post(reverse('matthews:target'), {'round': game.round, 'target': 0})
+        self.assertEqual(events.verify(Game.objects.get(id=game.id)), [])
+
+        client = login(Client(), game.players.order_by('id').first())
+        client.get(reverse('matthews:restart_round', kwargs={'round': 1}))
+        self.assertEqual(events.verify(Game.objects.get(id=game.id)), [])
+        client.get(reverse('matthews:restart'))
+        self.assertEqual(events.verify(Game.objects.get(id=game.id)), [])
+
+    def test_replays_from_checkpoints(self):
+        game = play_game(make_game(10), random.Random(7))
+        # starts from the first event rather than the checkpoints saved as rounds resolved
+        game.event_snapshots.all().delete()
+        expected = events.replay(game)
+        with mock.patch.object(events, 'CHECKPOINT_EVERY', 20), \
+             mock.patch.object(events, 'CHECKPOINT_DELAY', timedelta(0)):
+            self.assertEqual(events.replay(game), expected)
+            checkpoint = game.event_snapshots.get()
+            self.assertEqual(checkpoint.last_event_id, game.events.order_by('id').last().id)
+            with self.assertNumQueries(2):
+                self.assertEqual(events.replay(game), expected)
+
+    def test_checkpoints_as_rounds_resolve(self):
+        with mock.patch.object(events, 'CHECKPOINT_ROUNDS', 2):
+            game = play_game(make_game(10), random.Random(9), max_rounds=6)
+        checkpoints = list(game.event_snapshots.order_by('last_event_id'))
+        self.assertEqual(len(checkpoints), game.round // 2)
+        self.assertEqual(checkpoints[-1].state['round'], game.round // 2 * 2)
+        self.assertEqual(events.verify(game), [])
+
+    @override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+    def test_join_is_logged_with_the_player_or_not_at_all(self):
+        game = make_game(5, started=False)
+        kwargs = {'id': game.id, 'name': 'Newcomer', 'hash': views.make_invite_hash(game.id, 'Newcomer')}
+        with mock.patch.object(events, 'record', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                Client().get(reverse('matthews:join', kwargs=kwargs))
+        self.assertFalse(game.players.filter(name='Newcomer').exists())
+        self.assertEqual(events.verify(game), [])
+
+    def test_command_reports_differences(self):
+        game = play_game(make_game(8), random.Random(8), max_rounds=2)
+        call_command('replay_events', stdout=StringIO())
+        game.players.update(name='Renamed')
+        with self.assertRaises(CommandError):
+            call_command('replay_events', game.id, stdout=StringIO())
+
+
+class ArchiveTest(TestCase):
+
+    def make_old_game(self, num_players, seed):
+        game = play_game(make_game(num_players), random.Random(seed))
+        game.events.update(date_created=timezone.now() - timedelta(days=10))
+        return game
+
+    def test_archives_finished_games_and_loads_them(self):
+        game   = self.make_old_game(10, 1)
+        recent = play_game(make_game(6), random.Random(2))
+        expected = GameSnapshot(Game.objects.get(id=game.id))
+        num_actions = Action.objects.filter(game=game).count()
+
+        self.assertEqual(find_archivable_games(7, 30), [game.id])
+        call_command('archive_games', stdout=StringIO())
+
+        self.assertFalse(Game.objects.filter(id=game.id).exists())
+        self.assertFalse(Player.objects.filter(game_id=game.id).exists())
+        self.assertFalse(Action.objects.filter(game_id=game.id).exists())
+        self.assertTrue(Game.objects.filter(id=recent.id).exists())
+
+        snapshot = load_archived_game(game.id)
+        self.assertEqual(snapshot.game.results, expected.game.results)
+        self.assertEqual(snapshot.endgame_type, expected.endgame_type)
+        self.assertEqual([(x.id, x.name, x.character_id, x.died_in_round) for x in snapshot.players],
+                         [(x.id, x.name, x.character_id, x.died_in_round) for x in expected.players])
+        self.assertEqual(len(snapshot.actions), num_actions)
+        self.assertEqual(snapshot.events[0][0], events.JOINED)
+
+    def test_keeps_chains_of_games_together(self):
+        game = self.make_old_game(6, 3)
+        next_game = make_game(6, started=False)
+        Game.objects.filter(id=game.id).update(next_game=next_game)
+        self.assertEqual(find_archivable_games(7, 30), [])
+
+        next_game.events.update(date_created=timezone.now() - timedelta(days=40))
+        self.assertEqual(find_archivable_games(7, 30), [game.id, next_game.id])
+        archive_games([game.id, next_game.id])
+        self.assertEqual(load_archived_game(game.id).game.next_game_id, next_game.id)
+
+
+class DeathReportTest(TestCase):
+
+    def test_reports_are_filled_in_and_repeatable(self):
+        reports = set()
+        for seed in range(50):
+            report = make_death_report('Alice', seed)
+            self.assertEqual(report, make_death_report('Alice', seed))
+            self.assertIn('Alice', report)
+            for leftover in ['[', ']', '{{name}}']:
+                self.assertNotIn(leftover, report)
+            reports.add(report)
+        self.assertGreater(len(reports), 1)
+
+    def test_stored_on_death_and_cleared_by_restarts(self):
+        game = play_game(make_game(10), random.Random(3), max_rounds=4, choose_target=decisive_target)
+        dead = list(game.players.filter(died_in_round__isnull=False))
+        self.assertTrue(any(x.died_in_round >= 1 for x in dead))
+        for player in dead:
+            self.assertEqual(player.death_report, make_death_report(player.name, game.id + player.died_in_round))
+        self.assertFalse(game.players.filter(died_in_round__isnull=True, death_report__isnull=False).exists())
+
+        leader = login(Client(), game.players.order_by('id').first())
+        leader.get(reverse('matthews:restart_round', kwargs={'round': 1}))
+        self.assertFalse(game.players.filter(died_in_round__isnull=True, death_report__isnull=False).exists())
+        self.assertFalse(game.players.filter(died_in_round__gte=1).exists())
+
+        leader.get(reverse('matthews:restart'))
+        self.assertFalse(game.players.filter(death_report__isnull=False).exists())
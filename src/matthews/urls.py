@@ -10,6 +10,7 @@ urlpatterns = [
     path('game', views.game, name='game'),
     path('game/update-options', views.update_options, name='update_options'),
     path('game/state', views.state, name='state'),
+    path('game/wait', views.wait, name='wait'),
     path('game/remove-player/<int:id>', views.remove_player, name='remove_player'),
     path('game/start', views.start, name='start'),
     path('game/restart', views.restart, name='restart'),
@@ -0,0 +1,100 @@
+""" a per-game version number, bumped on every write, which pollers use to spot changes cheaply """
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F
+
+from project import metrics
+from .models import Game
+
+# woken whenever any game in this process changes; waiters then check their own game's version
+_changed = threading.Condition()
+# how many requests in this process are currently held in `wait_for_change`, see `waiter_slot`
+_num_waiters = 0
+_waiters_lock = threading.Lock()
+
+
+def bump_version(game):
+    """ marks the game as changed, which invalidates everything cached against its old version.
+        Call after the write, inside the same transaction. The cached version is only replaced
+        once the transaction commits (see `publish_version`): clearing it here would let a reader
+        cache the old version again from the database before the new one was visible
+    """
+    Game.objects.filter(id=game.id).update(version=F('version') + 1)
+    metrics.inc('matthews_state_changes_total')
+    transaction.on_commit(lambda: publish_version(game.id))
+
+
+def get_version(game_id):
+    """ returns the game's current version, from the cache shared by all workers where possible,
+        or None if the game doesn't exist
+    """
+    version = cache.get(_version_cache_key(game_id))
+    metrics.inc('matthews_version_cache_hits_total' if version is not None else 'matthews_version_cache_misses_total')
+    if version is None:
+        version = _read_version(game_id)
+        if version is not None:
+            # add rather than set, so a slow reader can't overwrite a newer published version
+            cache.add(_version_cache_key(game_id), version, settings.GAME_VERSION_CACHE_SECONDS)
+    return version
+
+
+def _read_version(game_id):
+    return Game.objects.filter(id=game_id).values_list('version', flat=True).first()
+
+
+def make_state_token(game_id, version):
+    """ returns a string which changes whenever anything in the game changes """
+    return '{}.{}'.format(game_id, version)
+
+
+def _version_cache_key(game_id):
+    return 'game-version-{}'.format(game_id)
+
+
+def publish_version(game_id):
+    """ shares the game's latest version with waiters in this process and, through the cache,
+        with those in other worker processes
+    """
+    cache.set(_version_cache_key(game_id), _read_version(game_id), settings.GAME_VERSION_CACHE_SECONDS)
+    with _changed:
+        _changed.notify_all()
+
+
+def wait_for_change(game_id, token, timeout):
+    """ blocks until the game's state token differs from `token` or `timeout` seconds pass, then
+        returns the latest token. Changes made in this process wake waiters straight away, those
+        made by other workers are picked up from the cache every LONG_POLL_CHECK_SECONDS
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        latest    = make_state_token(game_id, get_version(game_id))
+        remaining = deadline - time.monotonic()
+        if latest != token or remaining <= 0:
+            return latest
+        with _changed:
+            _changed.wait(min(remaining, settings.LONG_POLL_CHECK_SECONDS))
+
+
+@contextmanager
+def waiter_slot():
+    """ yields True if this process is holding fewer than LONG_POLL_MAX_WAITERS long-poll requests,
+        counting this one among them until the block exits, otherwise False. Each waiter ties up
+        one of the worker's threads, so past the cap they're turned away to poll instead, leaving
+        threads free for the requests which actually change the game
+    """
+    global _num_waiters
+    with _waiters_lock:
+        claimed = _num_waiters < settings.LONG_POLL_MAX_WAITERS
+        if claimed:
+            _num_waiters += 1
+    try:
+        yield claimed
+    finally:
+        if claimed:
+            with _waiters_lock:
+                _num_waiters -= 1
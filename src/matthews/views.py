@@ -2,8 +2,8 @@ from datetime import datetime
 from math import floor
 import random
 import hashlib
-import re
-import json
+from collections import Counter
+from functools import partial
 
 from django.shortcuts import render
 from django.contrib.auth.decorators import login_required
@@ -11,11 +11,19 @@ from django.http import HttpResponseRedirect, Http404, HttpResponse
 from django.urls import reverse
 from django.contrib import messages
 from django.conf import settings
-from django.db.models import Count, Q, F, FloatField
-from django.db.models.functions import Cast, Coalesce
+from django.db import transaction
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import quote_etag
 
-from project.emails import send_email
+from project import metrics
+from project.emails import queue_email
 from .models import *
+from . import events
+from .death_reports import make_death_report
+from .sessions import get_session_ids, set_session_ids, readonly_session
+from .snapshot import GameSnapshot
+from .stats import make_endgame_results, add_endgame_results, count_bad_guys_suspected
+from .versions import bump_version, get_version, make_state_token, wait_for_change, waiter_slot
 
 
 GAMEPLAY_OPTIONS = {
@@ -35,10 +43,11 @@ def new_game(request):
     game.save()
 
     if 'continue' in request.GET:
-        old_game_id = request.session['game_id']
+        old_game_id, _ = get_session_ids(request)
         old_game = Game.objects.get(id=old_game_id)
         old_game.next_game = game
-        old_game.save()
+        old_game.save(update_fields=['next_game'])
+        bump_version(old_game)
         game.options = old_game.options
         game.save()
         name = old_game.players.first().name
@@ -70,24 +79,31 @@ def invite(request, id):
         if game.date_started:
             raise Exception("This game has already started, blame {}".format(game.players.first().name))
 
-        for name, email in (x.split(',') for x in player_list.split('\n')):
-            name  = name.strip()
-            email = email.strip()
-            url   = make_invite_url(id, name)
-            msg = "Join game {}".format(url)
-            if '@' in email:
-                send_email([email], 'Join Matthews Game', html_content=msg, text_content=msg)
-            elif not Player.objects.filter(game=game, name=name).first():
-                player = Player(name=name, game=game)
-                player.save()
-            messages.add_message(request, messages.INFO, 'Player {} invited by email with {}'.format(name, url))
+        with transaction.atomic():
+            num_added = 0
+            for name, email in (x.split(',') for x in player_list.split('\n')):
+                name  = name.strip()
+                email = email.strip()
+                url   = make_invite_url(id, name)
+                msg = "Join game {}".format(url)
+                if '@' in email:
+                    queue_email([email], 'Join Matthews Game', html_content=msg, text_content=msg)
+                elif not Player.objects.filter(game=game, name=name).first():
+                    player = Player(name=name, game=game)
+                    player.save()
+                    events.record(game, events.JOINED, player_id=player.id, name=player.name)
+                    num_added += 1
+                messages.add_message(request, messages.INFO, 'Player {} invited by email with {}'.format(name, url))
+
+            if num_added:
+                bump_version(game)
 
         return HttpResponseRedirect(reverse('matthews:invite', kwargs={'id': game.id}))
 
     context = {
         'game':    game,
         'players': game.players.all(),
-        'my_player': Player.objects.filter(id=request.session.get('player_id')).first(),
+        'my_player': Player.objects.filter(id=get_session_ids(request)[1]).first(),
     }
     return HttpResponseRedirect(reverse('matthews:game'))
 
@@ -105,18 +121,21 @@ def join(request, id, name, hash):
             messages.add_message(request, messages.INFO, "That game has already started so you can't join")
             return HttpResponseRedirect(reverse('matthews:home'))
 
-        player = Player(name=name, game=game)
-        player.save()
+        with transaction.atomic():
+            player = Player(name=name, game=game)
+            player.save()
+            events.record(game, events.JOINED, player_id=player.id, name=player.name)
+            bump_version(game)
 
-    request.session['game_id']   = game.id
-    request.session['player_id'] = player.id
+    set_session_ids(request, game.id, player.id)
 
     return HttpResponseRedirect(reverse('matthews:game'))
 
 
 def update_options(request):
-    game = Game.objects.get(id=request.session['game_id'])
-    if game.players.all().order_by('id').first().id != request.session['player_id']:
+    game_id, player_id = get_session_ids(request)
+    game = Game.objects.get(id=game_id)
+    if game.players.all().order_by('id').first().id != player_id:
         raise Exception('Only leader can update game options')
 
     if game.date_started:
@@ -124,7 +143,8 @@ def update_options(request):
 
     if 'reset' in request.POST:
         game.options = None
-        game.save()
+        game.save(update_fields=['options'])
+        bump_version(game)
 
     else:
         roles = {int(id): {'min': int(request.POST.get('min_'+id)),
@@ -136,7 +156,8 @@ def update_options(request):
             'roles': roles,
             'gameplay': [x for x in request.POST.getlist('game_options[]')],
         }
-        game.save()
+        game.save(update_fields=['options'])
+        bump_version(game)
 
         if 'start' in request.POST:
             return start(request)
@@ -145,50 +166,65 @@ def update_options(request):
 
 
 def remove_player(request, id):
-    game = Game.objects.get(id=request.session['game_id'])
-    if game.players.all().order_by('id').first().id != request.session['player_id']:
+    game_id, player_id = get_session_ids(request)
+    game = Game.objects.get(id=game_id)
+    if game.players.all().order_by('id').first().id != player_id:
         raise Exception('Only leader can remove players')
 
     if game.date_started:
         raise Exception('Can\'t remove players from a game which has started')
 
     player = Player.objects.get(id=id, game=game)
-    player.delete()
+    with transaction.atomic():
+        events.record(game, events.LEFT, player_id=player.id)
+        player.delete()
+        game.recount_round()
+        bump_version(game)
 
     return HttpResponseRedirect(reverse('matthews:game'))
 
 
 def restart(request):
-    game = Game.objects.get(id=request.session['game_id'])
-    for player in game.players.all():
-        player.actions_by.all().delete()
-        player.died_in_round = None
-        player.character = None
-        player.save()
-    game.date_started = None
-    game.save()
+    with transaction.atomic():
+        game = lock_game(get_session_ids(request)[0])
+        Action.objects.filter(game=game).delete()
+        game.players.update(died_in_round=None, character=None, death_report=None)
+        game.date_started  = None
+        game.round         = 0
+        game.round_actions = 0
+        game.results       = None
+        game.save(update_fields=['date_started', 'round', 'round_actions', 'results'])
+        events.record(game, events.RESTARTED)
+        bump_version(game)
     return HttpResponseRedirect(reverse('matthews:game'))
 
 
 def restart_round(request, round):
-    game = Game.objects.get(id=request.session['game_id'])
-    if game.players.all().order_by('id').first().id != request.session['player_id']:
+    game_id, player_id = get_session_ids(request)
+    game = Game.objects.get(id=game_id)
+    if game.players.all().order_by('id').first().id != player_id:
         raise Exception('Only the leader can reset rounds')
 
-    Action.objects.filter(done_by__game=game, round__gte=round).delete()
-    for player in Player.objects.filter(game=game, died_in_round__gte=round):
-        player.died_in_round = None
-        player.save()
+    with transaction.atomic():
+        lock_game(game.id)
+        Action.objects.filter(game=game, round__gte=round).delete()
+        Player.objects.filter(game=game, died_in_round__gte=round).update(died_in_round=None, death_report=None)
+        Game.objects.filter(id=game.id, round__gte=round).update(round=round, round_actions=0)
+        Game.objects.filter(id=game.id).update(results=None)
+        events.record(game, events.ROUND_RESTARTED, round=round)
+        bump_version(game)
     return HttpResponseRedirect(reverse('matthews:game'))
 
 
 def start(request):
-    game = Game.objects.get(id=request.session['game_id'])
-    if game.players.all().order_by('id').first().id != request.session['player_id']:
+    game_id, player_id = get_session_ids(request)
+    game = Game.objects.get(id=game_id)
+    if game.players.all().order_by('id').first().id != player_id:
         raise Exception('Only the first player in the game can start it')
 
     rng = random.Random()
-    num_players = game.players.count()
+    players = list(game.players.all())
+    num_players = len(players)
 
 
     def probabilistic_round(float):
@@ -203,37 +239,68 @@ def start(request):
 
     random.Random().shuffle(character_ids)
 
-    for player in game.players.all():
+    for player in players:
         player.character_id = character_ids.pop()
-        player.save()
 
-    game.date_started = datetime.now()
-    game.save()
-
-    return HttpResponseRedirect(reverse('matthews:game'))
+    with transaction.atomic():
+        Player.objects.bulk_update(players, ['character'])
 
+        game.date_started = datetime.now()
+        game.save(update_fields=['date_started'])
+        events.record(game, events.STARTED, roles=[[x.id, x.character_id] for x in players])
+        bump_version(game)
 
-def build_game_state(game):
-    """ returns a string representing the state of the game """
-    action_ids = Action.objects.filter(done_by__game=game, round=calculate_round(game)) \
-                               .order_by('-id').values_list('id')
-    action_id_str = "".join([str(x[0]) for x in action_ids])
-    if game.date_started:
-        return "{}-{}".format(game.date_started, action_id_str)
-    else:
-        return "{}-{}".format(game.players.count(), hash(json.dumps(game.options)))
+    return HttpResponseRedirect(reverse('matthews:game'))
 
 
+@readonly_session
 def state(request):
-    game = Game.objects.get(id=request.session.get('game_id'))
-    return HttpResponse(build_game_state(game))
+    """ returns the game's state token, or a 304 if it matches the poller's If-None-Match """
+    game_id, _ = get_session_ids(request)
+    version = get_version(game_id)
+    if version is None:
+        raise Http404("Game not found")
+
+    token = make_state_token(game_id, version)
+    etag  = quote_etag(token)
+    not_modified = get_conditional_response(request, etag=etag)
+    metrics.inc('matthews_polls_total')
+    if not_modified:
+        metrics.inc('matthews_polls_unchanged_total')
+    response = not_modified or HttpResponse(token)
+    response['ETag'] = etag
+    patch_cache_control(response, no_cache=True)
+    return response
+
+
+@readonly_session
+def wait(request):
+    """ long-poll alternative to `state`: holds the request until the game's state token no longer
+        matches the `token` param (or LONG_POLL_SECONDS pass) and then returns the latest token.
+        Answers 503 if too many requests are already waiting, which sends the page back to polling
+    """
+    game_id, _ = get_session_ids(request)
+    with waiter_slot() as claimed:
+        if not claimed:
+            metrics.inc('matthews_polls_refused_total')
+            response = HttpResponse('Too many waiting players, poll instead', status=503)
+            response['Retry-After'] = settings.LONG_POLL_SECONDS
+            return response
+        token = wait_for_change(game_id, request.GET.get('token'), settings.LONG_POLL_SECONDS)
+    metrics.inc('matthews_polls_total')
+    if token == request.GET.get('token'):
+        metrics.inc('matthews_polls_unchanged_total')
+    response = HttpResponse(token)
+    patch_cache_control(response, no_cache=True, no_store=True)
+    return response
 
 
 def game(request):
 
     debug = request.GET.get('debug')
     if debug is not None:
-        request.session['debug'] = int(debug)
+        if request.session.get('debug') != int(debug):
+            request.session['debug'] = int(debug)
         messages.add_message(request, messages.INFO, 'debug set to {}'.format(debug))
         return HttpResponseRedirect(reverse('matthews:game'))
 
@@ -243,13 +310,18 @@ def game(request):
         request.session['player_id'] = int(play_as_id)
         return HttpResponseRedirect(reverse('matthews:game'))
 
-    game_id = request.session.get('game_id')
+    game_id, player_id = get_session_ids(request)
     if not game_id:
         messages.add_message(request, messages.INFO, "You're not currently in any game, follow the link in the invite email to join one")
         return HttpResponseRedirect(reverse('matthews:home'))
-    game = Game.objects.get(id=game_id)
-    round = calculate_round(game)
-    my_player = Player.objects.filter(id=request.session.get('player_id')).first()
+    try:
+        snapshot = GameSnapshot.load(game_id)
+    except Game.DoesNotExist:
+        messages.add_message(request, messages.INFO, "That game has finished and been archived, start a new one to keep playing")
+        return HttpResponseRedirect(reverse('matthews:home'))
+    game  = snapshot.game
+    round = snapshot.round
+    my_player = snapshot.get_player(player_id)
 
     if not my_player:
         messages.add_message(request, messages.INFO, 'Your player was kicked from the game')
@@ -259,10 +331,10 @@ def game(request):
 
     suspect = None
     if round % 2 == 0 and my_player.character_id == DETECTIVE_ID and not i_am_dead:
-        investigation = Action.objects.filter(round=round-1, done_by=my_player).first()
-        suspect = investigation.done_to if investigation else None
+        investigation = snapshot.get_action(my_player, round-1)
+        suspect = snapshot.get_player(investigation.done_to_id) if investigation else None
 
-    players = game.players.all()
+    players = snapshot.players
 
 
     default_roles = {
@@ -276,101 +348,29 @@ def game(request):
     role_options = {int(k): {**v, 'name': ROLE_NAMES[int(k)]}
                     for k,v in role_options.items()}
 
-    deaths = game.players.filter(died_in_round=round-1)
+    deaths = [x for x in players if x.died_in_round == round-1]
 
-    endgame_type = get_endgame_type(game)
-    bad_guy_ids = [MAFIA_ID]
-    good_guy_ids = [CIVILIAN_ID, DOCTOR_ID, DETECTIVE_ID]
-    day_regex   = '^\d*[02468]$'
-    night_regex = '^\d*[13579]$'
+    endgame_type = snapshot.endgame_type
     if endgame_type is not None:
-        was_alive_to_act         = Q(actions_by__round__lte=F('died_in_round')) | Q(died_in_round__isnull=True)
-        was_alive_to_be_acted_on = Q(actions_to__round__lte=F('died_in_round')) | Q(died_in_round__isnull=True)
-        players = players.annotate(lynched_bad=Count('actions_by', distinct=True,
-                                                     filter=Q(was_alive_to_act,
-                                                              actions_by__round__iregex=day_regex,
-                                                              actions_by__done_to__character_id__in=bad_guy_ids,
-                                                              actions_by__done_to__died_in_round=F('actions_by__round')))
-                        ).annotate(lynched_good=Count('actions_by', distinct=True,
-                                                      filter=Q(was_alive_to_act,
-                                                               actions_by__round__iregex=day_regex,
-                                                               actions_by__done_to__character_id__in=good_guy_ids,
-                                                               actions_by__done_to__died_in_round=F('actions_by__round')))
-                        ).annotate(killed_bad=Count('actions_by', distinct=True,
-                                                    filter=Q(was_alive_to_act,
-                                                             character_id=MAFIA_ID,
-                                                             actions_by__round__iregex=night_regex,
-                                                             actions_by__done_to__character_id__in=bad_guy_ids,
-                                                             actions_by__done_to__died_in_round=F('actions_by__round')))
-                        ).annotate(killed_good=Count('actions_by', distinct=True,
-                                                     filter=Q(was_alive_to_act,
-                                                              character_id=MAFIA_ID,
-                                                              actions_by__round__iregex=night_regex,
-                                                              actions_by__done_to__character_id__in=good_guy_ids,
-                                                              actions_by__done_to__died_in_round=F('actions_by__round')))
-                        ).annotate(killed_doctor=Count('actions_by', distinct=True,
-                                                     filter=Q(was_alive_to_act,
-                                                              character_id=MAFIA_ID,
-                                                              actions_by__round__iregex=night_regex,
-                                                              actions_by__done_to__character_id=DOCTOR_ID,
-                                                              actions_by__done_to__died_in_round=F('actions_by__round')))
-                        ).annotate(killed_detective=Count('actions_by', distinct=True,
-                                                     filter=Q(was_alive_to_act,
-                                                              character_id=MAFIA_ID,
-                                                              actions_by__round__iregex=night_regex,
-                                                              actions_by__done_to__character_id=DETECTIVE_ID,
-                                                              actions_by__done_to__died_in_round=F('actions_by__round')))
-                        ).annotate(lives_saved=Count('actions_by__round', distinct=True,
-                                                     filter=Q(was_alive_to_act,
-                                                              character_id=DOCTOR_ID,
-                                                              actions_by__round__iregex=night_regex,
-                                                              actions_by__done_to__actions_to__done_by__character_id__in=bad_guy_ids,
-                                                              actions_by__done_to__actions_to__round=F('actions_by__round')))
-                        ).annotate(suspected_bad_pc=Cast(Count('actions_by', distinct=True,
-                                                               filter=Q(was_alive_to_act,
-                                                                        character_id=CIVILIAN_ID,
-                                                                        actions_by__round__iregex=night_regex,
-                                                                        actions_by__done_to__character_id__in=bad_guy_ids)), FloatField())
-                                                    / Cast(Coalesce(F('died_in_round'), round) + 1 , FloatField())
-                                                    * 2 * 100
-                        ).annotate(successful_kill_pc=Cast(F('killed_good'), FloatField())
-                                                    / Cast(Coalesce(F('died_in_round') + 1, round) , FloatField())
-                                                    * 2 * 100
-                                  # this doesn't seem to take into account if mafia was alive
-                        ).annotate(mafia_target=Count('actions_to', distinct=True,
-                                                     filter=Q(was_alive_to_be_acted_on,
-                                                              actions_to__round__iregex=night_regex,
-                                                              actions_to__done_by__character_id__in=bad_guy_ids))
-                        ).annotate(mafia_found=Count('actions_by', distinct=True,
-                                                    filter=Q(was_alive_to_act,
-                                                             character_id=DETECTIVE_ID,
-                                                             actions_by__round__iregex=night_regex,
-                                                             actions_by__done_to__character_id__in=bad_guy_ids))
-        )
-
-        players = list(players)
+        if not game.results:
+            # games normally store their results as they finish, see save_action
+            game.results = make_endgame_results(game, players, round)
+            game.save(update_fields=['results'])
+            bump_version(game)
+        add_endgame_results(players, game.results)
         # todo - add extra params for awards, like so:
         # eg. players[2].favourite_person = "James"
     else:
-        players = players.annotate(has_acted=Count('actions_by', filter=Q(actions_by__round=round)))
-        players = list(players)
-
-        current_actions = Action.objects.filter(done_by__game=game, round=round)
+        current_actions = snapshot.actions_by(round)
         # decorate players with an action if they have one for this round
         for player in players:
-            for current_action in current_actions:
-                if player.id == current_action.done_by_id:
-                    player.action = current_action
+            player.action    = current_actions.get(player.id)
+            player.has_acted = int(player.action is not None)
 
         if 'show_suspicion_pc_on_death' in game.options.get('gameplay', {}) and round > 1:
+            correct_actions = count_bad_guys_suspected(deaths, before_round=round)
             for death in deaths:
-                correct_actions = death.actions_by.filter(round__iregex=night_regex,
-                                                          round__lt=round,
-                                                          done_to__character_id__in=bad_guy_ids) \
-                                                  .count()
-                death.suspicion_pc = int(correct_actions / floor(round / 2) * 100)
-
-    random.seed(game.id+round)
+                death.suspicion_pc = int(correct_actions.get(death.id, 0) / floor(round / 2) * 100)
 
     alive_players = [x for x in players if x.died_in_round is None]
     my_player.is_leader = my_player.id == players[0].id
@@ -384,112 +384,94 @@ def game(request):
         'is_day':           round % 2 == 0,
         'players':          players,
         'alive_players':    alive_players,
-        'random_leader':    random.choice(alive_players),
+        'random_leader':    random.Random(game.id+round).choice(alive_players),
         'my_player':        my_player,
-        'my_action':        Action.objects.filter(round=round, done_by=my_player).first(),
-        'num_actions':      Action.objects.filter(round=round, done_by__game=game).count(),
+        'my_action':        snapshot.get_action(my_player, round),
+        'num_actions':      game.round_actions,
         'action_undone':    request.GET.get('undone'),
-        'haunting_action':  get_haunting_action(my_player, round),
-        'game_state':       build_game_state(game),
-        'votes':            Action.objects.filter(round=round-1, done_by__game=game) \
-                                          .filter(Q(done_by__died_in_round__gte=round-1) | Q(done_by__died_in_round__isnull=True)) \
-                                          .order_by('done_to'),
+        'haunting_action':  get_haunting_action(snapshot, my_player, round),
+        'game_state':       snapshot.state_token,
+        'fragment_cache_seconds': settings.GAME_FRAGMENT_CACHE_SECONDS,
+        # only used inside cached fragments, so left for the template to call if it renders them
+        'vote_tallies':     partial(get_vote_tallies, snapshot, round-1),
         'deaths':           deaths,
-        'death_report':     make_death_report(deaths[0].name) if deaths else '',
+        'death_report':     partial(get_death_report, game, deaths[0]) if deaths else '',
         'suspect':          suspect,
         'MAFIA_ID':         MAFIA_ID,
         'DOCTOR_ID':        DOCTOR_ID,
         'DETECTIVE_ID':     DETECTIVE_ID,
         'CIVILIAN_ID':      CIVILIAN_ID,
         'endgame_type':     endgame_type,
+        'good_guys':        snapshot.list_good_guys(),
+        'bad_guys':         snapshot.list_bad_guys(),
     }
 
     if endgame_type and game.next_game_id:
         context.update({
-            'next_invite_url': make_invite_url(game.next_game.id, my_player.name),
+            'next_invite_url': make_invite_url(game.next_game_id, my_player.name),
         })
     return render(request, 'matthews/game.html', context)
 
 
-def get_haunting_action(player, round):
-    actions = Action.objects.filter(round=round-1, done_to=player, done_by__died_in_round__lt=round-1)
+def get_death_report(game, player):
+    """ returns the report stored when `player` died, making one for deaths from before they were stored """
+    return player.death_report or make_death_report(player.name, game.id + player.died_in_round)
+
+
+def get_haunting_action(snapshot, player, round):
+    actions = [x for x in snapshot.actions_to(round-1).get(player.id, [])
+               if snapshot.get_player(x.done_by_id).died_in_round is not None
+               and snapshot.get_player(x.done_by_id).died_in_round < round-1]
     if len(actions):
-        return random.Random().choice(list(actions))
-
-
-def make_death_report(name):
-    templates = [
-        [
-        "A [horrible,grim,ghastly,concerning,provocative,crazy,deeply unfortunate,regrettable,worrying,largely unexpected] \
-        incident at the [bakery,school,garden center,polio ward,RSPCA,nursing home,young offenders court,Tom Thumb home for tiny little boys] \
-        left {{name}} dead as [a dingbat,a doornail,Jimmy Saville,anything,a dodo,disco,can be].",
-
-        "Locals came across [a frankly baffling,a deeply worrying,a seemingly unsolvable,an exciting,a disgusting,some kind of] mystery \
-        this morning when they discovered the body of {{name}} \
-        locked inside [a suitcase,a mini-bar,a chest freezer,a really big one of those trinket necklaces,a coal scuttle,their own mind].",
-
-        "There was [chaos,pandemonium,a grim silence,a lot of tutting,an exchange of stern looks,a stampede,huge crowd,funky smell] \
-        at the [farmers' market,nail salon,corner by the square,edge of town,police cells,crack of dawn,AIDs parade,theatre matinee] this morning \
-        when {{name}}'s [head,arm,spine,severed right leg,spleen,limbless torso,still-sentient brain,decapitated head] was discovered \
-        floating in the [communal milk barrel,water tower,boating pond,second of Mrs Anderson's baths,shallowest puddle around,chef's stock pot].",
-        ],[
-        "[Police,First-responders,A young child,A hungry dog,One of those skinny runners you see,A travelling circus,The rugby sevens team,Celebrity Michael Sheen] \
-        found the body which had a [spatula,baked potato,half-complete Airfix kit,thicket of arrows,punt pole,sharpened leek,miniature version of the Eiffel Tower,number of swords,whole PlayStation controller,fencing foil] \
-        stuck into its [collarbone,clavicle,right temple,belly button,jugular,nose,squishy bits,back passage,mouth,toenail (but in a fatal fashion)]. \
-        They had lost a lot of blood.",
-
-        "The cause of death was unknown \"Apart from \
-        [being dead,their pale colour,male-pattern baldness,a history of alcoholism,narcolepsy,all that acne,avoidable childhood obesity,their different-length legs,a ghastly taste in fashion,poor personal hygiene,misjudged attempts at humour,general unlikeability] \
-        they appeared to be [in peak physical condition,in general good health,in ripping health,in fine form,in roaring shape,fit as a fiddle,reasonably sound of mind,quite well off,newly sober]\", said \
-        [the coroner,the chief of police,Mrs Ronson from number 34,a chorus of doctors,Michael Burke,no one ever,the most qualified person we could find to interview].",
-
-        "Authorities could only identify the body by its \
-        [winning smile,nubile physique,luscious sideburns,shoddy tattoos,expertly plucked eyebrows,one warty toe,overly complex genitalia,useless prehensile tail] \
-        and [Norway,penis,Mickey Mouse,heart,unfortunately,amusingly,nipple,upsettingly,Florida,star,not-quite-swastika]-shaped birth mark.",
-        ],[
-        "Our thoughts, prayers and [best wishes,cash prizes,minimal good will,fresh tears,suspicious glances,abject despair,sandwiches,mixed feelings] \
-        are with [the family,the whole world,no one in particular,their grieving widow,the concept of peace,in usual parameters,no clear target] at this difficult time.",
-
-        "The deceased leaves behind their pet [dog,iguana,zebra,chincilla,rattlesnake,panda,goldfish,Chubby,flamingo,colony of ants who are each named,rock,thermos flask of dna] {{name}} Jr. \
-        and an unmoved [spouse,set of triplets,mother-in-law,universe,autistic daughter,collection of vintage baseball cards,tree,conjoined twin,tape worm colony].",
-
-        "\"They were always into [hang-gliding,pot-holing,archery,other people's business,self-improvement,meditation,achieving one-ness,more debt than could ever be paid off,morbid cosplay,self-asphyxiation,weird shit]\", \
-        [a close friend,a passing cyclist,a disembodied voice,a street drunk,everyone we spoke to,the voice of time,a generic pundit,the local minister,someone special,their accountant,their one remaining friend,someone who didn't know them that well] \
-        remarked \"so I guess it's what they would have wanted\"",
-        ],
-    ]
-
-    report_lines = (re.sub(r'\[(.*?)\]',
-                           lambda m: random.choice(m.group(1).split(',')),
-                           random.choice(x).replace('{{name}}', name)
-                           )
-                    for x in templates)
-    return "\n".join(report_lines)
+        return random.Random().choice(actions)
 
 
-def target(request):
-    game   = Game.objects.get(id=request.session['game_id'])
-    player = Player.objects.get(id=request.session['player_id'])
-    round  = calculate_round(game)
+def get_vote_tallies(snapshot, round):
+    """ returns [(target, voters)] for the players who were alive to vote in `round`, ordered by
+        target, with a target of None for votes for nobody
+    """
+    tallies = []
+    for target_id, actions in sorted(snapshot.actions_to(round).items(), key=lambda x: x[0] or 0):
+        voters = [snapshot.get_player(x.done_by_id) for x in actions]
+        voters = [x for x in voters if x.died_in_round is None or x.died_in_round >= round]
+        if voters:
+            tallies.append((snapshot.get_player(target_id), voters))
+    return tallies
 
-    game_url = reverse('matthews:game')
 
-    if int(request.POST['round']) != round:
-        # don't save a vote from a round that's already finished (e.g. a late ghost vote)
-        if player.died_in_round is None or player.died_in_round > round:
-            # but only show a warning if we think they've tried to vote a second time
-            msg = "The voting for this round has closed - your last action was not counted."
-            messages.add_message(request, messages.WARNING, msg)
-    elif 'cancel' in request.POST:
-        action = Action.objects.filter(done_by=player, round=round)
-        action.delete()
-        game_url += '?undone=1'
-    else:
-        target = Player.objects.filter(id=request.POST['target']).first()
+def target(request):
+    game_url = reverse('matthews:game')
 
-        if target and target.game.id != game.id:
-            raise Exception("That player's not in this game")
-        save_action(game, player, target)
+    with transaction.atomic():
+        game_id, player_id = get_session_ids(request)
+        game     = lock_game(game_id)
+        snapshot = GameSnapshot(game)
+        player   = snapshot.get_player(player_id)
+        round    = snapshot.round
+
+        if not player:
+            raise Http404("You're not a player in this game")
+
+        if int(request.POST['round']) != round:
+            # don't save a vote from a round that's already finished (e.g. a late ghost vote)
+            if player.died_in_round is None or player.died_in_round > round:
+                # but only show a warning if we think they've tried to vote a second time
+                msg = "The voting for this round has closed - your last action was not counted."
+                messages.add_message(request, messages.WARNING, msg)
+        elif 'cancel' in request.POST:
+            num_deleted, _ = Action.objects.filter(game=game, round=round, done_by=player).delete()
+            game.add_round_actions(-num_deleted, len(snapshot.players))
+            if num_deleted:
+                events.record(game, events.UNDONE, round=round, done_by=player.id)
+            bump_version(game)
+            game_url += '?undone=1'
+        else:
+            target_id = int(request.POST['target'])
+            target = snapshot.get_player(target_id)
+
+            if target_id and not target:
+                raise Exception("That player's not in this game")
+            save_action(snapshot, player, target)
 
     return HttpResponseRedirect(game_url)
 
@@ -502,108 +484,117 @@ def test500(request):
     raise Exception("Test: An error occurred")
 
 
-def calculate_round(game):
-    return floor(Action.objects.filter(done_by__game=game).count() / game.players.count())
+def lock_game(game_id):
+    """ returns the game with its row locked until the end of the current transaction, so that
+        votes and round changes for it are handled one at a time
+    """
+    return Game.objects.select_for_update().get(id=game_id)
 
 
-def save_action(game, done_by, done_to):
-    round = calculate_round(game)
-    action = Action.objects.filter(round=round, done_by=done_by).first() \
-             or Action(round=round, done_by=done_by)
+def save_action(snapshot, done_by, done_to):
+    """ records `done_by`'s action for the current round and resolves the round if it was the
+        last one needed. Call inside a transaction holding the game's lock (see `lock_game`) with a
+        snapshot loaded after taking it
+    """
+    game  = snapshot.game
+    round = game.round
+    action = snapshot.get_action(done_by, round)
+    num_new_actions = 0 if action else 1
+    action = action or Action(game=game, round=round, done_by=done_by)
     action.done_to = done_to
     action.save()
+    snapshot.add_action(action)
+    log = [(events.CAST, {'round': round, 'done_by': done_by.id, 'done_to': done_to.id if done_to else None})]
 
     # Fill in blank actions for dead players who haven't acted so they don't hold up the game
-    non_voters = yet_to_vote(game, round)
-    if non_voters.count() == 0:
-        for corpse in yet_to_vote(game, round, False):
-            action = Action(round=round, done_by=corpse, done_to=None)
-            action.save()
-
-    if calculate_round(game) != round: # If this action completes a round of voting
-        victims = who_died(game, round)
+    if not snapshot.yet_to_vote(round):
+        # bulk_create skips Action.save(), so game and is_night are set here
+        corpse_actions = [Action(game=game, round=round, done_by=corpse, done_to=None, is_night=round % 2 == 1)
+                          for corpse in snapshot.yet_to_vote(round, False)]
+        Action.objects.bulk_create(corpse_actions)
+        for action in corpse_actions:
+            snapshot.add_action(action)
+            log.append((events.CAST, {'round': round, 'done_by': action.done_by_id, 'done_to': None}))
+        num_new_actions += len(corpse_actions)
+
+    completes_round = num_new_actions and game.add_round_actions(num_new_actions, len(snapshot.players))
+
+    metrics.inc('matthews_votes_total')
+    if completes_round:
+        metrics.inc('matthews_rounds_resolved_total')
+        with metrics.timer('matthews_who_died_seconds'):
+            victims = who_died(snapshot, round)
+        log.append((events.RESOLVED, {'round': round, 'victims': [x.id for x in victims]}))
         for victim in victims:
             victim.died_in_round = round
-            victim.save()
+            victim.death_report  = make_death_report(victim.name, game.id + round)
+            victim.save(update_fields=['died_in_round', 'death_report'])
 
+        if snapshot.endgame_type:
+            game.results = make_endgame_results(game, snapshot.players, game.round)
+            game.save(update_fields=['results'])
 
-def yet_to_vote(game, round, is_alive=True):
-    """ Return a query idenfying alive players who have not voted in this round
-    """
-    return game.players.filter(died_in_round__isnull=is_alive) \
-                       .exclude(actions_by__round=round)
+    events.record_many(game, log)
+    if completes_round and game.round % events.CHECKPOINT_ROUNDS == 0:
+        events.checkpoint(game)
+    bump_version(game)
 
 
-def who_died(game, round):
-    """ returns a list of players who were killed by the actions of this round
+def who_died(snapshot, round):
+    """ returns a list of players who were killed by the actions of this round, tallied from the
+        snapshot in one pass over the round's actions rather than with a query per rule
     """
+    num_good_guys = len(snapshot.list_good_guys())
+    num_bad_guys  = len(snapshot.list_bad_guys())
+
+    votes        = Counter()
+    good_votes   = Counter()
+    mafia_votes  = Counter()
+    doctor_saves = set()
+    for action in snapshot.actions_in_round(round):
+        actor = snapshot.get_player(action.done_by_id)
+        # only the actions of players who were alive at the time count
+        if actor.died_in_round is not None or not action.done_to_id:
+            continue
+        votes[action.done_to_id] += 1
+        if actor.character_id == MAFIA_ID:
+            mafia_votes[action.done_to_id] += 1
+        else:
+            good_votes[action.done_to_id] += 1
+        if actor.character_id == DOCTOR_ID:
+            doctor_saves.add(action.done_to_id)
 
     if round % 2 == 0: # process day vote
-        nominees = game.players.filter(actions_to__round=round,
-                                       actions_to__done_by__died_in_round__isnull=True) \
-                               .annotate(votes=Count('actions_to')) \
-                               .annotate(good_votes=Count('actions_to', filter=~Q(actions_to__done_by__character_id=MAFIA_ID))) \
-                               .order_by('-votes')
-        nominee = nominees.first()
-        num_alive_players = game.players.exclude(died_in_round__isnull=False).count()
-        if nominee and ( nominee.votes > num_alive_players / 2                  # Simple majority
-                         or nominee.good_votes == game.list_good_guys().count() # Good-guy consensus
-                        ):
-            return [nominee]
+        if not votes:
+            return []
+        nominee_id, num_votes = votes.most_common(1)[0]
+        if ( num_votes > (num_good_guys + num_bad_guys) / 2       # Simple majority
+             or good_votes[nominee_id] == num_good_guys           # Good-guy consensus
+            ):
+            return [snapshot.get_player(nominee_id)]
 
     else: # process night actions
-        targets = game.players.filter(actions_to__round=round,
-                                      actions_to__done_by__died_in_round__isnull=True,
-                                      actions_to__done_by__character_id=MAFIA_ID) \
-                           .annotate(votes=Count('actions_to')) \
-                           .order_by('-votes')
-
-        if not targets.count():
-            return[]
-        target = random.Random().choice(list(targets))
-
-        doctor_save_action = Action.objects.filter(done_by__game=game,
-                                                   round=round, done_to=target,
-                                                   done_by__character_id=DOCTOR_ID,
-                                                   done_by__died_in_round__isnull=True).first()
-
-        num_bad_guys  = game.list_bad_guys().count()
-        num_good_guys = game.list_good_guys().count()
-        if num_bad_guys == num_good_guys and target.votes < num_bad_guys:
+        if not mafia_votes:
+            return []
+        target_id = random.Random().choice(list(mafia_votes))
+
+        if num_bad_guys == num_good_guys and mafia_votes[target_id] < num_bad_guys:
             # reject a game-winning assassination if it's not done with consensus
             return []
 
-        if target and not doctor_save_action:
-            return [target]
+        if target_id not in doctor_saves:
+            return [snapshot.get_player(target_id)]
     return []
 
 
-def get_endgame_type(game):
-    """ returns 'bad' if bad guys win, 'good' if good guys win else None """
-    if not game.date_started:
-        return None
-
-    players = game.players.filter(died_in_round__isnull=True)
-    num_players = players.count()
-    num_bad  = game.list_bad_guys().count()
-    num_good = game.list_good_guys().count()
-
-    if num_bad == 0:
-        return 'good'
-    if num_bad > num_good:
-        return 'bad'
-    if num_bad == 1 and num_good == 1:
-        return 'truce'
-    return None
-
-
 def cast_all(request):
-    game = Game.objects.get(id=request.session['game_id'])
-    round = calculate_round(game)
-    non_voters = yet_to_vote(game, round)
-
-    target = None #non_voters.first()
-    for player in non_voters:
-        save_action(game, player, target)
+    with transaction.atomic():
+        game = lock_game(get_session_ids(request)[0])
+        snapshot = GameSnapshot(game)
+        non_voters = snapshot.yet_to_vote(snapshot.round)
+
+        target = None #non_voters[0]
+        for player in non_voters:
+            save_action(snapshot, player, target)
 
     return HttpResponseRedirect(reverse('matthews:game'))
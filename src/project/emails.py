@@ -1,7 +1,14 @@
 """ handles email sending """
+from datetime import timedelta
+
 from django.conf import settings
 from django.template.loader import render_to_string
-from django.core.mail import EmailMultiAlternatives
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.utils import timezone
+
+from matthews.models import QueuedEmail
+from . import metrics
+
 
 def send_email(recipients, subject, template_base=None, context={}, html_content=None, text_content=None):
     """ sends an email as directed, but observes instance email settings
@@ -11,8 +18,32 @@ def send_email(recipients, subject, template_base=None, context={}, html_content
         can be appended.
         @param `context` is a dict of data to be rendered into the template files
     """
+    email = prepare_email(recipients, subject, template_base, context, html_content, text_content)
+    if email:
+        email.send()
+        metrics.inc('matthews_emails_sent_total')
+
+
+def queue_email(recipients, subject, template_base=None, context={}, html_content=None, text_content=None):
+    """ as `send_email`, but saves the email for the send_queued_emails command to send so the
+        request doesn't have to wait on the SMTP server
+    """
+    email = prepare_email(recipients, subject, template_base, context, html_content, text_content)
+    if email:
+        QueuedEmail.objects.create(recipients=','.join(email.to),
+                                   subject=email.subject,
+                                   from_email=email.from_email,
+                                   text_content=email.body,
+                                   html_content=email.alternatives[0][0])
+        metrics.inc('matthews_emails_queued_total')
+
+
+def prepare_email(recipients, subject, template_base=None, context={}, html_content=None, text_content=None):
+    """ returns the email ready to send after applying instance email settings, or None if email
+        sending is blocked. Takes the same params as `send_email`
+    """
     if settings.BLOCK_EMAIL_SENDING:
-        return
+        return None
 
     if not settings.IS_PRODUCTION and not settings.SEND_ALL_EMAILS_TO:
         raise Exception('Email sending blocked from an instance with IS_PRODUCTION=False and SEND_ALL_EMAILS_TO not set')
@@ -35,4 +66,50 @@ def send_email(recipients, subject, template_base=None, context={}, html_content
     from_email = settings.SYSTEM_FROM_EMAIL
     email = EmailMultiAlternatives(subject, text_content, from_email, recipients)
     email.attach_alternative(html_content, "text/html")
-    email.send()
+    return email
+
+
+def send_queued_emails(batch_size):
+    """ sends up to `batch_size` queued emails which are due, all over one SMTP connection.
+        Failed emails are retried after an exponentially growing wait, up to
+        EMAIL_QUEUE_MAX_ATTEMPTS times. Returns the number of emails attempted
+    """
+    batch = list(QueuedEmail.objects.filter(date_sent__isnull=True,
+                                            attempts__lt=settings.EMAIL_QUEUE_MAX_ATTEMPTS,
+                                            next_attempt__lte=timezone.now())
+                                    .order_by('id')[:batch_size])
+    if not batch:
+        return 0
+
+    connection = get_connection()
+    try:
+        connection.open()
+    except Exception as e:
+        for queued in batch:
+            _reschedule(queued, e)
+        return len(batch)
+
+    try:
+        for queued in batch:
+            email = EmailMultiAlternatives(queued.subject, queued.text_content, queued.from_email,
+                                           queued.recipients.split(','), connection=connection)
+            email.attach_alternative(queued.html_content, "text/html")
+            try:
+                email.send()
+            except Exception as e:
+                _reschedule(queued, e)
+                continue
+            queued.date_sent = timezone.now()
+            queued.save(update_fields=['date_sent'])
+            metrics.inc('matthews_emails_sent_total')
+    finally:
+        connection.close()
+    return len(batch)
+
+
+def _reschedule(queued, error):
+    metrics.inc('matthews_emails_failed_total')
+    queued.attempts    += 1
+    queued.last_error   = repr(error)
+    queued.next_attempt = timezone.now() + timedelta(seconds=settings.EMAIL_QUEUE_RETRY_SECONDS * 2 ** queued.attempts)
+    queued.save(update_fields=['attempts', 'last_error', 'next_attempt'])
@@ -0,0 +1,121 @@
+""" game-engine counters and histograms, kept in the cache so every worker process adds to the same
+    numbers, and exposed in Prometheus' text format at /metrics when METRICS_ENABLED is set
+"""
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils import timezone
+
+from matthews.models import Game
+
+COUNTERS = {
+    'matthews_votes_total':                 'Votes cast by players',
+    'matthews_rounds_resolved_total':       'Rounds which every player has acted in',
+    'matthews_state_changes_total':         'Writes which changed a game, so its pollers have to reload it',
+    'matthews_polls_total':                 'Requests to the state and wait endpoints',
+    'matthews_polls_unchanged_total':       'Polls which found the game unchanged',
+    'matthews_polls_refused_total':         'Long polls turned away as too many were already waiting',
+    'matthews_emails_queued_total':         'Emails queued to be sent by send_queued_emails',
+    'matthews_emails_sent_total':           'Emails handed to the mail server',
+    'matthews_emails_failed_total':         'Attempts to send an email which failed',
+    'matthews_version_cache_hits_total':    'Game versions read from the cache',
+    'matthews_version_cache_misses_total':  'Game versions read from the database',
+    'matthews_snapshot_cache_hits_total':   'Game snapshots read from the cache',
+    'matthews_snapshot_cache_misses_total': 'Game snapshots loaded from the database',
+}
+
+# name: (help, upper bounds of the buckets in seconds)
+HISTOGRAMS = {
+    'matthews_who_died_seconds': ('Time taken to work out who died at the end of a round',
+                                  [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, float('inf')]),
+}
+
+# games which were started this recently and haven't ended count as active
+ACTIVE_GAME_HOURS = 12
+
+
+def inc(name, amount=1):
+    """ adds `amount` to the counter `name` """
+    if settings.METRICS_ENABLED:
+        _incr(_key(name), amount)
+
+
+def observe(name, seconds):
+    """ records `seconds` in the histogram `name` """
+    if settings.METRICS_ENABLED:
+        bounds = HISTOGRAMS[name][1]
+        _incr(_key(name, bounds[bisect_left(bounds, seconds)]))
+        _incr(_key(name, 'count'))
+        # sums are kept in microseconds as the cache can only increment integers
+        _incr(_key(name, 'sum'), int(seconds * 1000000))
+
+
+@contextmanager
+def timer(name):
+    """ records how long the block takes in the histogram `name` """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start)
+
+
+def _incr(key, amount=1):
+    """ increments atomically across processes where the cache supports it (memcached does) and
+        never raises, as metrics mustn't break the request being measured
+    """
+    try:
+        cache.incr(key, amount)
+    except ValueError:
+        # the key doesn't exist yet, unless another process has just added it
+        if not cache.add(key, amount, timeout=None):
+            try:
+                cache.incr(key, amount)
+            except ValueError:
+                pass
+
+
+def _key(name, suffix=None):
+    return 'metrics-{}'.format(name) if suffix is None else 'metrics-{}-{}'.format(name, suffix)
+
+
+def render_metrics():
+    """ returns every metric in Prometheus' text exposition format """
+    keys = [_key(name) for name in COUNTERS]
+    for name, (_, bounds) in HISTOGRAMS.items():
+        keys += [_key(name, bound) for bound in bounds] + [_key(name, 'count'), _key(name, 'sum')]
+    values = cache.get_many(keys)
+
+    lines = []
+    for name, help in COUNTERS.items():
+        lines += ['# HELP {} {}'.format(name, help),
+                  '# TYPE {} counter'.format(name),
+                  '{} {}'.format(name, values.get(_key(name), 0))]
+
+    for name, (help, bounds) in HISTOGRAMS.items():
+        lines += ['# HELP {} {}'.format(name, help),
+                  '# TYPE {} histogram'.format(name)]
+        cumulative = 0
+        for bound in bounds:
+            cumulative += values.get(_key(name, bound), 0)
+            le = '+Inf' if bound == float('inf') else bound
+            lines.append('{}_bucket{{le="{}"}} {}'.format(name, le, cumulative))
+        lines += ['{}_sum {}'.format(name, values.get(_key(name, 'sum'), 0) / 1000000),
+                  '{}_count {}'.format(name, values.get(_key(name, 'count'), 0))]
+
+    since = timezone.now() - timedelta(hours=ACTIVE_GAME_HOURS)
+    active_games = Game.objects.filter(date_started__gte=since, results__isnull=True).count()
+    lines += ['# HELP matthews_active_games Games started in the last {} hours which have not ended'
+              .format(ACTIVE_GAME_HOURS),
+              '# TYPE matthews_active_games gauge',
+              'matthews_active_games {}'.format(active_games)]
+    return '\n'.join(lines) + '\n'
+
+
+def metrics(request):
+    return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,149 @@
+""" records how long each view takes, how long it spends in the database and how many queries it makes """
+import cProfile
+import json
+import logging
+import os
+import random
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+# upper bounds of each histogram's buckets
+MS_BUCKETS    = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, float('inf')]
+COUNT_BUCKETS = [0, 1, 2, 5, 10, 20, 50, 100, 200, 500, float('inf')]
+BYTES_BUCKETS = [1000, 10000, 50000, 100000, 500000, 1000000, float('inf')]
+
+
+class Histogram:
+    """ counts values into fixed buckets, so recording one is cheap and memory use doesn't grow """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts  = [0] * len(buckets)
+        self.count   = 0
+        self.sum     = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum   += value
+
+    def as_dict(self):
+        return {
+            'buckets': {str(bound): count for bound, count in zip(self.buckets, self.counts)},
+            'count':   self.count,
+            'sum':     self.sum,
+        }
+
+
+def _make_view_stats():
+    return {
+        'wall_ms': Histogram(MS_BUCKETS),
+        'db_ms':   Histogram(MS_BUCKETS),
+        'queries': Histogram(COUNT_BUCKETS),
+        'bytes':   Histogram(BYTES_BUCKETS),
+    }
+
+
+_lock  = threading.Lock()
+_stats = defaultdict(_make_view_stats)
+
+
+def record_request(view_name, wall_ms, db_ms, num_queries, num_bytes):
+    with _lock:
+        stats = _stats[view_name]
+        stats['wall_ms'].observe(wall_ms)
+        stats['db_ms'].observe(db_ms)
+        stats['queries'].observe(num_queries)
+        if num_bytes is not None:
+            stats['bytes'].observe(num_bytes)
+
+
+def get_request_stats():
+    """ returns a copy of this process's histograms as {view name: {measure: histogram dict}} """
+    with _lock:
+        return {view: {name: x.as_dict() for name, x in stats.items()} for view, stats in _stats.items()}
+
+
+def reset_request_stats():
+    with _lock:
+        _stats.clear()
+
+
+class QueryTimer:
+    """ a database execute wrapper which counts queries and adds up the time spent in them """
+
+    def __init__(self):
+        self.count = 0
+        self.ms    = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.ms    += (time.perf_counter() - start) * 1000
+
+
+class ProfilingMiddleware:
+    """ records every request into the histograms above, optionally logging each one as a line of
+        JSON and saving cProfile stats for a sampled fraction of requests to PROFILE_VIEWS
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        queries = QueryTimer()
+        start   = time.perf_counter()
+        with connection.execute_wrapper(queries):
+            response = self.get_response(request)
+        wall_ms = (time.perf_counter() - start) * 1000
+
+        view_name = request.resolver_match.view_name if request.resolver_match else 'unresolved'
+        num_bytes = None if response.streaming else len(response.content)
+        record_request(view_name, wall_ms, queries.ms, queries.count, num_bytes)
+
+        profiler = getattr(request, 'profiler', None)
+        if profiler:
+            profiler.disable()
+            self.save_profile(profiler, view_name)
+
+        if settings.PROFILE_LOG_REQUESTS:
+            logger.info(json.dumps({
+                'time':    time.time(),
+                'pid':     os.getpid(),
+                'method':  request.method,
+                'path':    request.path,
+                'view':    view_name,
+                'status':  response.status_code,
+                'wall_ms': round(wall_ms, 2),
+                'db_ms':   round(queries.ms, 2),
+                'queries': queries.count,
+                'bytes':   num_bytes,
+            }))
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if (request.resolver_match.view_name in settings.PROFILE_VIEWS
+                and random.random() < settings.PROFILE_SAMPLE_RATE):
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                # another thread's request is already being profiled
+                return None
+            request.profiler = profiler
+        return None
+
+    def save_profile(self, profiler, view_name):
+        os.makedirs(settings.PROFILE_DIR, exist_ok=True)
+        filename = '{}-{}-{}.prof'.format(view_name.replace(':', '-'), int(time.time() * 1000), os.getpid())
+        profiler.dump_stats(os.path.join(settings.PROFILE_DIR, filename))
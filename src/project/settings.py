@@ -123,6 +123,10 @@ CACHES = {
     }
 }
 
+# Sessions are read from the cache, falling back to the database they're written through to, so
+# polling players don't cost a session query each time
+SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+
 # Password validation
 # https://docs.djangoproject.com/en/2.0/ref/settings/#auth-password-validators
 
@@ -228,4 +232,63 @@ SEND_ALL_EMAILS_TO      = env('DJANGO_SEND_ALL_EMAILS_TO', default=None)
 CUSTOMER_SERVICES_EMAIL = env('DJANGO_CUSTOMER_SERVICES_EMAIL', default=None)
 SYSTEM_FROM_EMAIL       = env('DJANGO_SYSTEM_FROM_EMAIL', default=False)
 
+# Queued emails (see project.emails.queue_email) are sent in batches by the send_queued_emails
+# command. Failures are retried after RETRY_SECONDS * 2^attempts
+EMAIL_QUEUE_BATCH_SIZE    = 50
+EMAIL_QUEUE_MAX_ATTEMPTS  = 5
+EMAIL_QUEUE_RETRY_SECONDS = 30
+
 PASSWORD_RESET_WINDOW_SECONDS = 7 * 24 * 60 * 60  # links expire after 7 days
+
+# How long a waiting player's long-poll request is held open before they re-ask, and how often it
+# checks for changes made by other workers
+LONG_POLL_SECONDS       = env.int('DJANGO_LONG_POLL_SECONDS', default=25)
+LONG_POLL_CHECK_SECONDS = 1
+# Each waiting request holds one of its worker's threads (see run.sh), so past this many in a
+# process players are sent back to polling, leaving the other threads to serve the game itself
+LONG_POLL_MAX_WAITERS   = env.int('DJANGO_LONG_POLL_MAX_WAITERS', default=10)
+
+# Games' versions are written through to the cache on every change, so these timeouts are only a
+# safety net; snapshots are keyed by version so never go stale, they just stop being used
+GAME_VERSION_CACHE_SECONDS  = 60
+GAME_SNAPSHOT_CACHE_SECONDS = 10 * 60
+
+# The parts of game.html every player sees the same way (the newspaper, with its death report and
+# vote breakdown) are cached against the game's state token, so are rendered once per change
+GAME_FRAGMENT_CACHE_SECONDS = 10 * 60
+
+# Request profiling (see project.profiling) keeps histograms of every view's timings and query
+# counts in memory. It can also log each request as a line of JSON to logs/requests.log, and save
+# cProfile stats for PROFILE_SAMPLE_RATE of the requests to PROFILE_VIEWS into logs/profiles/
+PROFILE_REQUESTS     = env.bool('DJANGO_PROFILE_REQUESTS', default=False)
+PROFILE_LOG_REQUESTS = env.bool('DJANGO_PROFILE_LOG_REQUESTS', default=False)
+PROFILE_VIEWS        = env.list('DJANGO_PROFILE_VIEWS', default=['matthews:game'])
+PROFILE_SAMPLE_RATE  = env.float('DJANGO_PROFILE_SAMPLE_RATE', default=0)
+PROFILE_DIR          = os.path.join(REPO_BASE_DIR, 'logs', 'profiles')
+
+if PROFILE_REQUESTS:
+    MIDDLEWARE.insert(0, 'project.profiling.ProfilingMiddleware')
+
+if PROFILE_LOG_REQUESTS:
+    LOGGING = {
+        'version': 1,
+        'disable_existing_loggers': False,
+        'formatters': {
+            'message': {'format': '%(message)s'},
+        },
+        'handlers': {
+            'requests_file': {
+                # reopens the file if it's rotated, and appends so every gunicorn worker can share it
+                'class':     'logging.handlers.WatchedFileHandler',
+                'filename':  os.path.join(REPO_BASE_DIR, 'logs', 'requests.log'),
+                'formatter': 'message',
+            },
+        },
+        'loggers': {
+            'project.profiling': {'handlers': ['requests_file'], 'level': 'INFO', 'propagate': False},
+        },
+    }
+
+# Game-engine metrics (see project.metrics) are counted in the cache, so are shared by all the
+# gunicorn workers, and served at /metrics for Prometheus to scrape
+METRICS_ENABLED = env.bool('DJANGO_METRICS_ENABLED', default=False)
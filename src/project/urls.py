@@ -26,6 +26,12 @@ urlpatterns = [
 ] + static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
 
 
+if settings.METRICS_ENABLED:
+    from . import metrics
+    urlpatterns += [
+        path('metrics', metrics.metrics, name='metrics'),
+    ]
+
 if settings.SHOW_DEBUG_TOOLBAR:
     import debug_toolbar
     urlpatterns = [